@@ -1,39 +1,21 @@
 from langchain.chains import LLMChain
-from langchain.memory import ConversationBufferMemory
 from langchain.memory.chat_message_histories import StreamlitChatMessageHistory
-from langchain.prompts import PromptTemplate
-from langchain.chat_models import ChatOpenAI
 import streamlit as st
 import streamlit_ext as ste
 from dotenv import load_dotenv
 import os
 
+from providers import get_client, history_token_budget
+from chat_memory import TokenBudgetMemory
+from prompting import PersonaChatPrompt
+from persona_cache import compile_persona
+from streaming import STREAMING, stream_chain, run_chain
+from interview_log import INTERVIEW_LOG, get_interview_log, new_session_id
+from transcript import Transcript
+from chat_window import paged_messages
+from metering import metering, session_meter, show_usage
+
 
-def clean_conversation(text):
-    # Split the text into individual messages
-    messages = text.split('), ')
-
-    # Process each message to extract the content
-    cleaned_messages = []
-    for message in messages:
-        # Find the start and end of the content section
-        start_index = message.find('content="') + 9
-        end_index = message.find('", additional')
-        
-        # Extract the content and add it to the cleaned messages list
-        content = message[start_index:end_index]
-        cleaned_messages.append(content)
-
-    # Join the cleaned messages into a single string with line breaks for readability
-    cleaned_text = '\n'.join(cleaned_messages)
-    
-    # Remove the specified terms
-    cleaned_text = cleaned_text.replace("additional_kwargs={}, ", "")
-    cleaned_text = cleaned_text.replace("example=Fals", "")
-    cleaned_text = cleaned_text.replace("sage(content=", "Human: ")
-    
-    return cleaned_text
-    
 #API keys
 load_dotenv()
 openai_api_key= os.getenv("OPENAI_API_KEY")
@@ -77,10 +59,42 @@ st.warning("""
 
 persona = st.text_area("Please enter the persona you want PEARL to emulate:")
 
+#instructions the persona is compiled into (the persona and history are sent as chat messages)
+template = """You are participanting in an interview with a researcher. Respond to the questions asked by the researcher. Repond to one question at a time.
+Your main objective is to stay in character throughout the entire conversation, adapting to the persona's characteristics, mannerisms, and knowledge. 
+Please provide a coherent, engaging, and in-character response to any questions or statements you receive. 
+
+The persona you are emulating:
+{profile}"""
+
 #setup memory
 msgs = StreamlitChatMessageHistory(key="langchain_messages")
-memory = ConversationBufferMemory(memory_key="chat_history", chat_memory=msgs)
+#the persona is the first message of the history and is never condensed
+memory = TokenBudgetMemory(memory_key="chat_history", chat_memory=msgs, model="gpt-4-turbo", max_token_limit=history_token_budget("gpt-4-turbo"), pinned_messages=1, return_messages=True)
 view_messages = st.expander("View the message contents in session state")
+#the download is extended turn by turn instead of being rebuilt from the history
+if "transcript" not in st.session_state:
+    st.session_state.transcript = Transcript()
+transcript = st.session_state.transcript
+
+#durable interview log: resume the session named in the URL, or start a new one
+interview_log = get_interview_log() if INTERVIEW_LOG else None
+if interview_log and "session_id" not in st.session_state:
+    session_id = st.query_params.get("session")
+    if interview_log.exists(session_id):
+        for record in interview_log.load(session_id):
+            if record["type"] == "persona":
+                msgs.add_ai_message(record["profile"])
+                transcript.persona = record["profile"]
+                st.session_state.persona = compile_persona(record["profile"], template)
+            elif record["type"] == "turn":
+                msgs.add_user_message(record["question"])
+                msgs.add_ai_message(record["answer"])
+                transcript.add(record["question"], record["answer"])
+    else:
+        session_id = new_session_id()
+    st.session_state.session_id = session_id
+    st.query_params["session"] = session_id
 
 if st.button("Emulate Persona!"):
     if not persona:
@@ -88,37 +102,46 @@ if st.button("Emulate Persona!"):
         st.stop()
     else:
         msgs.add_ai_message(persona)
+        transcript.persona = persona
+        #compiled once and shared with every session emulating the same persona
+        st.session_state.persona = compile_persona(persona, template)
+        if interview_log:
+            interview_log.append(st.session_state.session_id, "persona", profile=persona)
         st.success("The following persona has been emulated and ready to be interview:")
 
 
-# Set up the LLMChain, passing in memory
-template = """You are participanting in an interview with a researcher. Respond to the questions asked by the researcher. Repond to one question at a time.
-                Your main objective is to stay in character throughout the entire conversation, adapting to the persona's characteristics, mannerisms, and knowledge. 
-                Please provide a coherent, engaging, and in-character response to any questions or statements you receive. 
-
-                Current conversation:
-                {chat_history}
-                Human: {input}
-                AI:"""
-prompt = PromptTemplate(
-    input_variables=["chat_history", "input"],
-    template=template)
-llm = ChatOpenAI(temperature=0.5, openai_api_key=openai_api_key, model_name="gpt-4-turbo", request_timeout=120)
-llm_chain = LLMChain(llm=llm, prompt=prompt, memory=memory, verbose=False)
-
-# Render current messages from StreamlitChatMessageHistory
-for msg in msgs.messages:
+# Set up the LLMChain, passing in memory; it is rebuilt only when another persona is emulated
+compiled = st.session_state.get("persona")
+llm = get_client("openai", "gpt-4-turbo", openai_api_key, temperature=0.5, request_timeout=120)
+if "llm_chain" not in st.session_state or (compiled is not None and st.session_state.llm_chain.prompt is not compiled.prompt("openai")):
+    if compiled is not None:
+        prompt = compiled.prompt("openai")
+    else:
+        #no persona compiled yet: the persona stored at the start of the history is appended
+        prompt = PersonaChatPrompt(instructions=template.format(profile="").rstrip(), provider="openai")
+    st.session_state.llm_chain = LLMChain(llm=llm, prompt=prompt, memory=memory, verbose=False)
+llm_chain = st.session_state.llm_chain
+
+# Render the latest messages from StreamlitChatMessageHistory (older ones on request)
+for msg in paged_messages(msgs.messages):
     st.chat_message(msg.type).write(msg.content)
 
 # If user inputs a new prompt, generate and draw a new response
 if prompt := st.chat_input():
     st.chat_message("human").write(prompt)
-    # Note: new messages are saved to history automatically by Langchain during run
-    response = llm_chain.run(prompt)
-    st.chat_message("ai").write(response)
+    # Note: new messages are saved to history automatically by Langchain during run;
+    # the call waits its turn in the process-wide scheduler and its usage is metered
+    with metering(session_meter()):
+        if STREAMING:
+            response = st.chat_message("ai").write_stream(stream_chain(llm_chain, {"input": prompt}, provider="openai"))
+        else:
+            response = run_chain(llm_chain, {"input": prompt}, provider="openai")
+            st.chat_message("ai").write(response)
+    transcript.add(prompt, response)
+    if interview_log:
+        interview_log.append(st.session_state.session_id, "turn", question=prompt, answer=response)
 
 if len(msgs.messages) != 0:
-    data_str = str(st.session_state.langchain_messages)
     st.sidebar.divider()
-    data_str_clean = clean_conversation(data_str)
-    ste.sidebar.download_button("Download Chat", data_str_clean, "interview.txt")
\ No newline at end of file
+    ste.sidebar.download_button("Download Chat", transcript.export("txt"), "interview.txt")
+    show_usage(session_meter())
\ No newline at end of file
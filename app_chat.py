@@ -1,25 +1,32 @@
 #external libraries
-from openai import OpenAI
 import streamlit as st
 import streamlit_ext as ste
-import json
-from streamlit_chat import message
+from streamlit.runtime.scriptrunner import RerunData, get_script_run_ctx
 
 #langchain libraries
-from langchain import PromptTemplate
 from langchain.chains import ConversationChain 
-from langchain.chat_models import ChatOpenAI
-from langchain.chat_models import ChatAnthropic
-from langchain_groq import ChatGroq
 from langchain.memory import ConversationBufferMemory
-import google.generativeai as genai
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_deepseek import ChatDeepSeek
+
+#PEARL modules
+from providers import MODELS, DEFAULT_MODEL, IMPORT_BUDGET, get_llm, history_token_budget, import_report
+from chat_memory import budgeted_memory
+from persona_cache import compile_persona, get_persona_cache
+from transcript import FORMATS, Transcript
+from streaming import STREAMING, stream_chain, run_chain, replay_chain, commit_chain, merge_streams
+from response_cache import RESPONSE_CACHE, cache_key, get_response_cache
+from routing import FALLBACK_ORDER, HEDGE_AFTER, routed_llm
+from telemetry import TurnStats, timed_stream
+from interview_log import INTERVIEW_LOG, get_interview_log, new_session_id, replay
+from chat_window import paged_messages
+from scheduler import get_scheduler, reporting_queue
+from http_pool import pool_report
+from session_spill import SESSION_SPILL, get_session_spill
+from metering import get_usage_ledger, metering, session_meter, usage_caption
+from speculation import SPECULATION, SUGGESTION_POLL, session_speculator
+from tracing import finish_trace, phase, show_waterfall, span, start_trace, traced, tracing_enabled
 
 #Python libraries
-import os
 from dotenv import load_dotenv
-import time
 
 # Page configuration with a modern theme
 st.set_page_config(
@@ -34,6 +41,10 @@ st.set_page_config(
     }
 )
 
+# With PEARL_TRACE=1 (or ?trace=1) every rerun is traced phase by phase
+start_trace("app_chat")
+phase("css")
+
 # Custom CSS for a more professional look
 st.markdown("""
 <style>
@@ -162,28 +173,68 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# Session state keys holding the interview history (spilled to disk while the session is idle)
+HISTORY_KEYS = ["messages", "past", "generated", "stored_session", "entity_memory", "transcript", "turn_stats", "compare_memories"]
+
 # Functions
 def get_text():
     input_text = st.text_area("Write your question in the text-box: ", st.session_state["input"], key="input", placeholder="Hi there, can you tell me a bit about yourself?")
     return input_text
 
-def format_transcript(data):
-    transcript = json.loads(data)
-    result = ""
-    for item in transcript:
-        if len(item) == 2:
-            question, answer = item
-            answer = answer.replace("\\n", "\n")
-            result += f"{question}\n{answer}\n"
+def comparison_text(replies):
+    return "\n\n".join(f"[{label}]\n{reply}" for label, reply in replies.items())
+
+def ask_suggestion(question):
+    """Ask a suggested follow-up question (button callback)."""
+    st.session_state.suggested_question = question
+
+def touch_session():
+    """Mark this session active, reading its history back first if it was spilled (call before using it)."""
+    if session_spill:
+        session_spill.touch(HISTORY_KEYS, drop=["conversation", "conversation_key", "compare_chains"])
+
+def restore_session(records):
+    """Rebuild this session's interview from its log records (no LLM calls)."""
+    profile, turns = replay(records)
+    st.session_state.profile = profile or ""
+    st.session_state.persona = compile_persona(st.session_state.profile)
+    st.session_state.persona_set = profile is not None
+    st.session_state.entity_memory.clear()
+    st.session_state.compare_memories = {}
+    st.session_state.compare_chains = {}
+    st.session_state.messages = []
+    st.session_state["past"] = []
+    st.session_state["generated"] = []
+    st.session_state.transcript = Transcript()
+    for turn in turns:
+        question = turn["question"]
+        if "answers" in turn:
+            for label, answer in turn["answers"].items():
+                memory = st.session_state.compare_memories.setdefault(
+                    label, ConversationBufferMemory(memory_key="chat_history", input_key="input", return_messages=True)
+                )
+                memory.chat_memory.add_user_message(question)
+                memory.chat_memory.add_ai_message(answer)
+            output = comparison_text(turn["answers"])
+            reply = {"role": "assistant", "content": output, "comparison": turn["answers"]}
         else:
-            st.write(f"Skipping item due to irregular structure: {item}")
-    return result
+            output = turn["answer"]
+            st.session_state.entity_memory.chat_memory.add_user_message(question)
+            st.session_state.entity_memory.chat_memory.add_ai_message(output)
+            reply = {"role": "assistant", "content": output, "model": turn.get("model")}
+        st.session_state.messages += [{"role": "user", "content": question}, reply]
+        st.session_state["past"].append(question)
+        st.session_state["generated"].append(output)
+        st.session_state.transcript.add(question, output, turn.get("model"))
+
+phase("session")
 
 # Load environment variables
 load_dotenv()
-client_openai = OpenAI()
-client_openai.api_key = os.getenv("OPENAI_API_KEY")
-api_openai = client_openai.api_key
+
+# Read back the history of a session that sat idle long enough to be spilled to disk
+session_spill = get_session_spill() if SESSION_SPILL else None
+touch_session()
 
 # Session state initialization
 if "generated" not in st.session_state:
@@ -197,9 +248,29 @@ if "stored_session" not in st.session_state:
 if 'messages' not in st.session_state:
     st.session_state.messages = []
 if 'entity_memory' not in st.session_state:
-    st.session_state.entity_memory = ConversationBufferMemory(memory_key="chat_history", input_key="input")
+    st.session_state.entity_memory = ConversationBufferMemory(memory_key="chat_history", input_key="input", return_messages=True)
+if 'transcript' not in st.session_state:
+    st.session_state.transcript = Transcript()
+if 'turn_stats' not in st.session_state:
+    st.session_state.turn_stats = []
+if 'compare_memories' not in st.session_state:
+    st.session_state.compare_memories = {}
+if 'compare_chains' not in st.session_state:
+    st.session_state.compare_chains = {}
+
+# Durable interview log: resume the session named in the URL, or start a new one
+interview_log = get_interview_log() if INTERVIEW_LOG else None
+if interview_log and "session_id" not in st.session_state:
+    session_id = st.query_params.get("session")
+    if interview_log.exists(session_id):
+        restore_session(interview_log.load(session_id))
+    else:
+        session_id = new_session_id()
+    st.session_state.session_id = session_id
+    st.query_params["session"] = session_id
 
 # Sidebar with app information
+phase("sidebar")
 with st.sidebar:
     st.image("https://img.icons8.com/?size=100&id=b2rw9AoJdaQb&format=png&color=000000", width=80)
     with st.expander("About PEARL"):
@@ -249,9 +320,40 @@ with st.sidebar:
             2. Create a detailed persona description
             3. Click "Emulate Persona"
             4. Start chatting with your AI persona
-            5. Download the conversation at the bottom of the sidebar when finished
+            5. Download the conversation below the chat when finished
             """
         )
+
+    st.markdown("<h3>Settings</h3>", unsafe_allow_html=True)
+    stream_responses = st.toggle("Stream responses", value=STREAMING, help="Show the persona's reply as it is being written")
+    compare_mode = st.toggle("Compare models side by side", help="Ask every question to several models at once, each keeping its own memory of the interview")
+    use_response_cache = st.toggle("Reuse cached answers", value=RESPONSE_CACHE, help="Answer repeated questions to the same persona from a cache shared by all sessions. Leave off when every reply must be a fresh sample.")
+    budget_history = st.toggle("Limit memory to recent turns", value=True, help="Keep the latest turns word for word within the selected model's token budget and condense older ones")
+    speculate = st.toggle("Suggest follow-up questions", value=SPECULATION, help="After each reply, suggest likely follow-up questions and prepare the persona's answers in the background, so a suggestion is answered at once. Uses extra tokens, within a budget per session.")
+    recall_turns = st.toggle("Recall relevant earlier turns", value=True, disabled=not budget_history, help="Instead of condensing older turns, add the earlier exchanges most related to each new question (for very long interviews)")
+    with st.expander("Provider failover"):
+        fallback_models = st.multiselect(
+            "Fallback models, in order",
+            list(MODELS),
+            default=FALLBACK_ORDER,
+            help="Tried in this order when the selected model fails or its circuit breaker is open",
+        )
+        hedge_after = st.number_input(
+            "Start the next model if no reply after (seconds, 0 = off)",
+            min_value=0.0,
+            value=HEDGE_AFTER,
+            step=1.0,
+        )
+    if interview_log:
+        with st.expander("Session"):
+            st.caption(f"Session ID: `{st.session_state.session_id}`")
+            resume_id = st.text_input("Resume a session by ID").strip()
+            if st.button("Resume session", disabled=not resume_id):
+                if interview_log.exists(resume_id):
+                    st.query_params["session"] = resume_id
+                    del st.session_state["session_id"]
+                    st.rerun()
+                st.error("No interview log for this session ID.")
     
     st.divider()
 
@@ -283,59 +385,59 @@ st.markdown("""
 </div>
 """, unsafe_allow_html=True)
 
+# The model selector, the persona form and the chat area are fragments: using one
+# of them reruns only that part of the page, not the whole script. They share the
+# selected model and persona through st.session_state.
+
 # Model selection with visual indicators
+phase("model selection")
 st.markdown("### 🤖 Select AI Model")
 st.markdown("Choose the AI model that will power your persona simulation:")
 
-model_col1, model_col2 = st.columns(2)
-with model_col1:
-    llm_model = st.selectbox(
-        "AI Model",
-        ["GPT 4o", "Sonnet 3.7", "Gemini Flash", "DeepSeek Chat"],
-        label_visibility="collapsed"
-    )
+@st.fragment
+@traced("model_selector")
+def model_selector(compare_mode):
+    model_col1, model_col2 = st.columns(2)
+    with model_col1:
+        llm_model = st.selectbox(
+            "AI Model",
+            list(MODELS),
+            label_visibility="collapsed",
+            key="llm_model",
+        )
 
-with model_col2:
-    if llm_model == "GPT 4o":
-        st.markdown("**OpenAI's GPT-4o**: Advanced reasoning and knowledge")
-    elif llm_model == "Sonnet 3.7":
-        st.markdown("**Anthropic's Claude 3.7 Sonnet**: Nuanced understanding and responses")
-    elif llm_model == "Gemini Flash":
-        st.markdown("**Google's Gemini Flash**: Fast, efficient responses")
-    elif llm_model == "DeepSeek Chat":
-        st.markdown("**DeepSeek Chat**: Specialized knowledge model")
-
-# Initialize the selected model
-with st.spinner(f"Initializing {llm_model}..."):
-    if llm_model == "GPT 4o":
-        llm = ChatOpenAI(api_key=api_openai, model_name="gpt-4o")
-    elif llm_model == "Sonnet 3.7":
-        try:
-            from langchain_anthropic import ChatAnthropic
-            llm = ChatAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), model_name="claude-3-7-sonnet-20250219")
-        except (ImportError, AttributeError):
-            llm = ChatAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), model_name="claude-3-7-sonnet-20250219", anthropic_api_key=os.getenv("ANTHROPIC_API_KEY"))
-    elif llm_model == "Gemini Flash":
-        try:
-            llm = ChatGoogleGenerativeAI(
-                model="gemini-2.0-flash",
-                google_api_key=os.getenv("GOOGLE_API_KEY"),
-            )
-        except Exception as e:
-            genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-            llm = ChatGoogleGenerativeAI(
-                model="gemini-2.0-flash",
-                safety_settings={"HARASSMENT": "block_none"},
-            )
-    elif llm_model == "DeepSeek Chat":
-        llm = ChatDeepSeek(api_key=os.getenv("DEEPSEEK_API_KEY"), model_name="deepseek-chat")
-    else:
-        # Default fallback in case none of the conditions match
-        st.warning(f"Model {llm_model} not recognized. Using GPT-4o as fallback.")
-        llm = ChatOpenAI(api_key=api_openai, model_name="gpt-4o")
+    with model_col2:
+        if llm_model == "GPT 4o":
+            st.markdown("**OpenAI's GPT-4o**: Advanced reasoning and knowledge")
+        elif llm_model == "Sonnet 3.7":
+            st.markdown("**Anthropic's Claude 3.7 Sonnet**: Nuanced understanding and responses")
+        elif llm_model == "Gemini Flash":
+            st.markdown("**Google's Gemini Flash**: Fast, efficient responses")
+        elif llm_model == "DeepSeek Chat":
+            st.markdown("**DeepSeek Chat**: Specialized knowledge model")
+        elif MODELS.get(llm_model, {}).get("provider") == "fake":
+            st.markdown("**Fake model**: Offline filler answers for load tests")
+
+    if compare_mode:
+        st.multiselect(
+            "Models to compare",
+            list(MODELS),
+            default=list(MODELS)[:2],
+            key="compare_models",
+        )
+
+    # Initialize the selected model (clients are shared across reruns and sessions)
+    with st.spinner(f"Initializing {llm_model}..."), span("model init", model=llm_model):
+        if llm_model not in MODELS:
+            # Default fallback in case none of the conditions match
+            st.warning(f"Model {llm_model} not recognized. Using GPT-4o as fallback.")
+        get_llm(llm_model if llm_model in MODELS else DEFAULT_MODEL)
+
+model_selector(compare_mode)
 st.markdown("</div>", unsafe_allow_html=True)
 
 # Persona creation section
+phase("persona")
 st.markdown("<div class='model-selector' style='background-color: #F0F8FF; padding: 15px; border-radius: 8px; margin-bottom: 20px;'>", unsafe_allow_html=True)
 st.markdown("### 👤 Create Your Persona")
 
@@ -354,148 +456,464 @@ with st.expander("See example persona"):
     
     Katarina is a 40-year-old Canadian math teacher with a Master's degree in Mathematics Education. She has been teaching for 15 years at a public high school in a suburban area outside Toronto. She loves helping students understand complex math concepts and is particularly passionate about making math accessible to girls. Katarina is patient, methodical, and has a dry sense of humor. She struggles with work-life balance and is considering pursuing administration roles.    """)
 
-profile = st.text_area(
-    "Enter your persona description:",
-    height=150,
-    placeholder="Describe the persona you want PEARL to emulate in detail...",
-    label_visibility="collapsed"
-)
-
-emulate_col1, emulate_col2 = st.columns([1, 3])
-with emulate_col1:
-    emulate_button = st.button("✨ Emulate Persona", use_container_width=True)
-st.markdown("</div>", unsafe_allow_html=True)
+@st.fragment
+@traced("persona_form")
+def persona_form():
+    touch_session()
+    profile = st.text_area(
+        "Enter your persona description:",
+        height=150,
+        placeholder="Describe the persona you want PEARL to emulate in detail...",
+        label_visibility="collapsed",
+        key="profile",
+    )
 
-if emulate_button:
-    with st.spinner("Initializing persona..."):
-        # Add a small delay for visual effect
-        time.sleep(0.5)
-        
+    emulate_col1, emulate_col2 = st.columns([1, 3])
+    with emulate_col1:
+        emulate_button = st.button("✨ Emulate Persona", use_container_width=True)
+
+    if emulate_button:
+        with st.spinner("Initializing persona..."):
+            # Set session state
+            if 'persona_set' not in st.session_state:
+                st.session_state.persona_set = True
+            # Compile the persona once (shared with every session emulating the same one)
+            st.session_state.persona = compile_persona(profile)
+            
+            # Clear previous conversation
+            st.session_state.entity_memory.clear()
+            for memory in st.session_state.compare_memories.values():
+                memory.clear()
+            st.session_state["generated"] = []
+            st.session_state["past"] = []
+            st.session_state.messages = []
+            st.session_state.transcript = Transcript()
+            if interview_log:
+                interview_log.append(st.session_state.session_id, "persona", profile=profile)
+        # The chat area has to be cleared too, so rerun the whole page once
+        st.session_state.persona_activated = True
+        st.rerun()
+
+    if st.session_state.pop("persona_activated", False):
         # Success message with animation
-        success_placeholder = st.empty()
-        success_placeholder.markdown(f"""
+        st.markdown(f"""
         <div style="background-color: #ECFDF5; padding: 15px; border-radius: 10px; border-left: 5px solid #10B981; margin-bottom: 20px; animation: fadeIn 0.5s;">
             <p style="margin: 0; color: #10B981;">
                 <strong>✅ Persona activated!</strong> PEARL will now emulate: {profile}
             </p>
         </div>
         """, unsafe_allow_html=True)
-        
-        # Set session state
-        if 'persona_set' not in st.session_state:
-            st.session_state.persona_set = True
-        
-        # Clear previous conversation
-        st.session_state.entity_memory.clear()
-        st.session_state["generated"] = []
-        st.session_state["past"] = []
-        st.session_state.messages = []
+
+persona_form()
+st.markdown("</div>", unsafe_allow_html=True)
 
 # Chat interface
 #st.markdown("<div class='chat-container'>", unsafe_allow_html=True)
 st.markdown("### 💬 Interview Your Persona")
+phase("chat")
+
+def rerun_chat_area():
+    """Rerun only the chat area fragment, from another fragment.
+
+    st.rerun(scope="fragment") would rerun the calling fragment and a plain
+    st.rerun() the whole page; this queues the chat area the way the browser
+    does when one of its widgets changes.
+    """
+    ctx = get_script_run_ctx()
+    fragment_id = st.session_state.get("chat_area_fragment")
+    if ctx is None or ctx.script_requests is None or fragment_id is None:
+        st.rerun()
+    ctx.script_requests.request_rerun(RerunData(
+        query_string=ctx.query_string,
+        page_script_hash=ctx.page_script_hash,
+        fragment_id=fragment_id,
+        is_fragment_scoped_rerun=True,
+    ))
+    # Yield so the runner stops here and starts the requested run
+    st.empty()
+
+@st.fragment(run_every=SUGGESTION_POLL)
+def suggestion_poller():
+    # Once suggestions the chat area has not drawn yet are ready, only the chat area is drawn again.
+    # It is called by the page, not the chat area: every call of a run_every fragment adds a
+    # browser timer, and only a full page run clears them.
+    if not get_script_run_ctx().fragment_ids_this_run:
+        # A full page run has just drawn the chat area
+        return
+    speculator = session_speculator()
+    if speculator.current is not None and speculator.suggestions() is not None \
+            and st.session_state.get("suggestions_drawn") != id(speculator.current):
+        rerun_chat_area()
+
+@st.fragment
+@traced("chat_area")
+def chat_area(stream_responses, compare_mode, use_response_cache, budget_history, recall_turns, speculate, fallback_models, hedge_after):
+    touch_session()
+    # The suggestion poller reruns this fragment (not the page) when suggestions are ready
+    st.session_state.chat_area_fragment = get_script_run_ctx().current_fragment_id
+    # Model and persona come from the other fragments, which may have rerun on their own
+    llm_model = st.session_state.llm_model if st.session_state.llm_model in MODELS else DEFAULT_MODEL
+    profile = st.session_state.profile
+    persona = st.session_state.get("persona")
+    if persona is None or persona.source != profile:
+        persona = st.session_state.persona = compile_persona(profile)
+    compare_models = st.session_state.get("compare_models", []) if compare_mode else []
+    llm = get_llm(llm_model)
+
+    # Conversation memory: the full interview, or recent turns within the model's token budget
+    phase("memory budget")
+    provider_model = MODELS[llm_model]["model"]
+    st.session_state.entity_memory = budgeted_memory(
+        st.session_state.entity_memory,
+        budget_history,
+        provider_model,
+        history_token_budget(provider_model),
+        recall=recall_turns,
+    )
 
-# Template for conversation
-template = """You are following persona: {profile}. Engage in conversations with a researcher. 
-Your main objective is to stay in character throughout the entire conversation, adapting to the persona's characteristics, mannerisms, and knowledge.
-Please provide a coherent, engaging, and in-character response to any questions or statements you receive. You are being interviewed by a researcher, so you should answer the questions in a way that is helpful to the researcher.
-
-Current conversation:
-{chat_history}
-Human: {input}
-AI:"""
-
-prompt = PromptTemplate(
-    input_variables=["chat_history", "input"],
-    partial_variables={"profile": profile},
-    template=template
-)
-
-# Create conversation chain
-conversation = ConversationChain(
-    llm=llm, 
-    prompt=prompt, 
-    memory=st.session_state.entity_memory,
-)
-
-# Display chat messages
-for message in st.session_state.messages:
-    with st.chat_message(message["role"], avatar="👤" if message["role"] == "user" else "🧠"):
-        st.markdown(message["content"])
-
-# Chat input
-user_input = st.chat_input("Ask a question to your persona...", key="chat_input")
-
-# Process user input
-if user_input:
-    # Add user message to chat history
-    st.session_state.messages.append({"role": "user", "content": user_input})
-    
-    # Display user message
-    with st.chat_message("user", avatar="👤"):
-        st.markdown(user_input)
-    
-    # Generate response with status indicator
-    with st.status("Generating response...", expanded=True) as status:
-        st.write(f"The AI is formulating a response as your persona...")
+    # Create prompt and conversation chain once per model/persona/memory for this session
+    phase("chain construction")
+    chain_key = (llm_model, persona.hash, budget_history, recall_turns, tuple(fallback_models), hedge_after)
+    if st.session_state.get("conversation_key") != chain_key:
+        st.session_state.conversation = ConversationChain(
+            llm=routed_llm(llm_model, fallback_models, hedge_after=hedge_after), 
+            prompt=persona.prompt(MODELS[llm_model]["provider"]), 
+            memory=st.session_state.entity_memory,
+        )
+        st.session_state.conversation_key = chain_key
+    conversation = st.session_state.conversation
+
+    # One chain and memory per compared model, so each model keeps its own version of the interview
+    compare_chains = {}
+    for label in compare_models:
+        label_model = MODELS[label]["model"]
+        memory = st.session_state.compare_memories.get(label)
+        if memory is None:
+            memory = ConversationBufferMemory(memory_key="chat_history", input_key="input", return_messages=True)
+        memory = budgeted_memory(memory, budget_history, label_model, history_token_budget(label_model), recall=recall_turns)
+        st.session_state.compare_memories[label] = memory
+        compare_key = (persona.hash, budget_history, recall_turns)
+        chain, chain_key = st.session_state.setdefault("compare_chains", {}).get(label, (None, None))
+        if chain_key != compare_key:
+            chain = ConversationChain(
+                llm=routed_llm(label),
+                prompt=persona.prompt(MODELS[label]["provider"]),
+                memory=memory,
+            )
+            st.session_state.compare_chains[label] = (chain, compare_key)
+        compare_chains[label] = chain
+
+    # Display chat messages (the latest exchanges, older ones on request)
+    phase("history rendering")
+    history = st.container()
+    with history:
+        for message in paged_messages(st.session_state.messages):
+            with st.chat_message(message["role"], avatar="👤" if message["role"] == "user" else "🧠"):
+                if "comparison" in message:
+                    replies = message["comparison"]
+                    for column, (label, reply) in zip(st.columns(len(replies)), replies.items()):
+                        with column:
+                            st.markdown(f"**{label}**")
+                            st.markdown(reply)
+                else:
+                    st.markdown(message["content"])
+
+    # Suggested follow-up questions are drawn here once this run's reply is done
+    suggestions_area = st.container()
+    speculator = session_speculator()
+
+    # Chat input (inside a fragment it sits below the conversation instead of being pinned to the page)
+    user_input = st.chat_input("Ask a question to your persona...", key="chat_input")
+    suggested = st.session_state.pop("suggested_question", None)
+    if suggested and not user_input:
+        user_input = suggested
+
+    # Process user input
+    phase("reply")
+    if user_input and not compare_mode:
+        with history:
+            # Add user message to chat history
+            st.session_state.messages.append({"role": "user", "content": user_input})
+            
+            # Display user message
+            with st.chat_message("user", avatar="👤"):
+                st.markdown(user_input)
+            
+            # Time this turn from submission to the last token; tokens and cost go to the session's meter
+            stats = TurnStats(model=llm_model, provider_model=provider_model)
+            meter = session_meter()
+            status = st.status("Generating response...", expanded=False)
+            # Under load the call waits for a free slot of the provider
+            queue_update = lambda position: status.update(label=f"Waiting for {llm_model}: #{position} in the queue...")
+            
+            # Look up the same question at the same point of the same interview in the shared cache
+            cached_output = None
+            if use_response_cache:
+                response_cache = get_response_cache()
+                response_key = cache_key(
+                    provider_model,
+                    getattr(llm, "temperature", None),
+                    profile,
+                    conversation.memory.load_memory_variables({})["chat_history"],
+                    user_input,
+                )
+                cached_output = response_cache.get(response_key)
+            
+            # A suggested question may have been answered in the background already; the rest are discarded
+            speculative = None
+            if speculate and cached_output is None:
+                speculative = speculator.take(user_input, len(conversation.memory.chat_memory.messages))
+            speculator.discard()
+            
+            if cached_output is not None:
+                # Answer from the cache and commit it to memory without calling the model
+                stats.cached_response = True
+                stats.start()
+                output = "".join(replay_chain(conversation, {"input": user_input}, cached_output))
+                stats.finish(output)
+                with st.chat_message("assistant", avatar="🤖"):
+                    st.markdown(output)
+            elif speculative is not None:
+                # The memory only gets the exchange appended
+                stats.speculative_response = True
+                if speculative["answered_by"]:
+                    stats.usage["answered_by"] = speculative["answered_by"]
+                stats.start()
+                output = speculative["answer"]
+                commit_chain(conversation, {"input": user_input}, output)
+                stats.finish(output)
+                with st.chat_message("assistant", avatar="🤖"):
+                    st.markdown(output)
+            elif stream_responses:
+                # Stream the response into the chat bubble as it is generated
+                with st.chat_message("assistant", avatar="🤖"), reporting_queue(queue_update), metering(meter):
+                    output = st.write_stream(timed_stream(
+                        stream_chain(conversation, {"input": user_input}, usage=stats.usage),
+                        stats,
+                        on_update=lambda stats: status.update(label=stats.label()),
+                    ))
+            else:
+                # Generate actual response
+                stats.start()
+                with reporting_queue(queue_update), metering(meter):
+                    output = run_chain(conversation, {"input": user_input}, usage=stats.usage)
+                stats.finish(output)
+                
+                # Display assistant response
+                with st.chat_message("assistant", avatar="🤖"):
+                    st.markdown(output)
+            
+            # Only replies of the selected model are cached under its key, never a fallback's
+            if use_response_cache and cached_output is None and stats.answered_by == llm_model:
+                response_cache.put(response_key, provider_model, output)
+            
+            # Update status with the measured timings
+            status.update(label=stats.label(), state="complete")
+            with status:
+                st.json(stats.as_dict())
+            st.session_state.turn_stats.append(stats.as_dict())
+            
+            # Update history
+            if stats.answered_by != llm_model:
+                st.caption(f"Answered by {stats.answered_by} (fallback for {llm_model})")
+        st.session_state.messages.append({"role": "assistant", "content": output, "model": stats.answered_by})
+        st.session_state['past'].append(user_input)
+        st.session_state['generated'].append(output)
+        st.session_state.transcript.add(user_input, output, stats.answered_by)
+        if interview_log:
+            interview_log.append(st.session_state.session_id, "turn", question=user_input, answer=output, model=stats.answered_by)
         
-        # Progress indicator
-        progress_bar = st.progress(0)
-        for i in range(100):
-            # Simulate thinking process
-            time.sleep(0.01)
-            progress_bar.progress(i + 1)
+        # Prepare answers to likely follow-up questions while this reply is being read
+        if speculate:
+            with metering(meter):
+                speculator.start(conversation)
         
-        # Generate actual response
-        with st.spinner():
-            output = conversation.run(input=user_input)
+        # Auto-scroll to bottom (using JavaScript)
+        #st.markdown("""
+       # <script>
+            #function scrollToBottom() {
+                #const mainContainer = document.querySelector('.main');
+                #mainContainer.scrollTop = mainContainer.scrollHeight;
+            #}
+            #scrollToBottom();
+        #</script>
+        #""", unsafe_allow_html=True)
+    #st.markdown("</div>", unsafe_allow_html=True)
+
+    # Process user input in comparison mode: every selected model answers in its own column
+    if user_input and compare_mode and compare_models:
+        speculator.discard()
+        with history:
+            st.session_state.messages.append({"role": "user", "content": user_input})
             
-        # Update status
-        status.update(label="Response ready!", state="complete")
-    
-    # Display assistant response
-    with st.chat_message("assistant", avatar="🤖"):
-        st.markdown(output)
-    
-    # Update history
-    st.session_state.messages.append({"role": "assistant", "content": output})
-    st.session_state['past'].append(user_input)
-    st.session_state['generated'].append(output)
-    
-    # Auto-scroll to bottom (using JavaScript)
-    #st.markdown("""
-   # <script>
-        #function scrollToBottom() {
-            #const mainContainer = document.querySelector('.main');
-            #mainContainer.scrollTop = mainContainer.scrollHeight;
-        #}
-        #scrollToBottom();
-    #</script>
-    #""", unsafe_allow_html=True)
-#st.markdown("</div>", unsafe_allow_html=True)
-
-# Download chat option
-if st.session_state.messages and len(st.session_state.messages) > 1:
-    #st.markdown("<div style='background-color: white; padding: 20px; border-radius: 10px; box-shadow: 0 2px 4px rgba(0, 0, 0, 0.05);'>", unsafe_allow_html=True)
-    #st.markdown("### 📥 Save Your Interview")
-    #st.markdown("Download the complete conversation transcript for your research records:")
-    
-    conversations = [(st.session_state['past'][i], st.session_state["generated"][i]) for i in range(len(st.session_state['generated']))]
-    if conversations:
-        conversations_str = json.dumps(conversations)
-        formatted_output = format_transcript(conversations_str)
+            with st.chat_message("user", avatar="👤"):
+                st.markdown(user_input)
+            
+            with st.chat_message("assistant", avatar="🤖"):
+                placeholders, captions, replies, compare_stats, streams = {}, {}, {}, {}, {}
+                for label, column in zip(compare_models, st.columns(len(compare_models))):
+                    with column:
+                        st.markdown(f"**{label}**")
+                        placeholders[label] = st.empty()
+                        captions[label] = st.empty()
+                    replies[label] = ""
+                    compare_stats[label] = TurnStats(model=label, provider_model=MODELS[label]["model"])
+                    streams[label] = timed_stream(
+                        stream_chain(compare_chains[label], {"input": user_input}, usage=compare_stats[label].usage),
+                        compare_stats[label],
+                    )
+                
+                # The models answer in parallel, so the turn takes as long as the slowest one
+                with metering(session_meter()):
+                    for label, text in merge_streams(streams):
+                        if isinstance(text, Exception):
+                            # A failed model has no answer to record, even if part of one was streamed
+                            replies.pop(label, None)
+                            placeholders[label].empty()
+                            captions[label].error(f"{label} failed: {text}")
+                        elif text is None:
+                            placeholders[label].markdown(replies[label])
+                            captions[label].caption(compare_stats[label].label())
+                            st.session_state.turn_stats.append(compare_stats[label].as_dict())
+                        else:
+                            replies[label] += text
+                            placeholders[label].markdown(replies[label] + "▌")
         
-        # Move download button to sidebar
-        with st.sidebar:
-            st.divider()
-            st.markdown("<h3>Download Interview</h3>", unsafe_allow_html=True)
-            ste.download_button(
-                "📄 Download Transcript", 
-                formatted_output, 
-                "pearl_interview.txt"
+        # Update history with the models that answered; a turn no model answered is not recorded
+        if replies:
+            output = comparison_text(replies)
+            st.session_state.messages.append({"role": "assistant", "content": output, "comparison": replies})
+            st.session_state['past'].append(user_input)
+            st.session_state['generated'].append(output)
+            st.session_state.transcript.add(user_input, output)
+            if interview_log:
+                interview_log.append(st.session_state.session_id, "turn", question=user_input, answers=replies)
+        else:
+            st.session_state.messages.pop()
+    elif user_input and compare_mode:
+        st.info("Select at least one model to compare.")
+
+    # Suggested follow-up questions
+    if speculate and not compare_mode:
+        with suggestions_area:
+            suggestions = speculator.suggestions()
+            if suggestions is None:
+                st.caption("💭 Preparing suggested follow-up questions...")
+            else:
+                st.session_state.suggestions_drawn = id(speculator.current)
+            if suggestions:
+                st.caption("Suggested follow-up questions (answered in advance)")
+                for i, question in enumerate(suggestions):
+                    st.button(question, key=f"suggestion_{i}", on_click=ask_suggestion, args=(question,))
+
+    # Download chat option (fragments cannot write to the sidebar, so it sits below the chat)
+    phase("transcript formatting")
+    transcript = st.session_state.transcript
+    if len(transcript):
+        download_col, stats_col, usage_col = st.columns(3)
+        with download_col:
+            with st.expander("📥 Download Interview"):
+                # The transcript is built turn by turn, so this only picks up the ready export
+                transcript_format = st.selectbox(
+                    "Format",
+                    list(FORMATS),
+                    format_func=lambda fmt: FORMATS[fmt][0],
+                )
+                ste.download_button(
+                    "📄 Download Transcript", 
+                    transcript.export(transcript_format), 
+                    f"pearl_interview.{transcript_format}",
+                    mime=FORMATS[transcript_format][1],
+                )
+                st.markdown(f"<small>Interview contains {len(transcript)} exchanges</small>", unsafe_allow_html=True)
+
+        # Response time history for this session
+        with stats_col:
+            if st.session_state.turn_stats:
+                with st.expander("⏱️ Response times"):
+                    st.dataframe(st.session_state.turn_stats, hide_index=True)
+
+                    # Shared response cache counters
+                    if use_response_cache:
+                        cache_stats = get_response_cache().stats()
+                        st.caption(
+                            f"Response cache: {cache_stats['hits']} hits · {cache_stats['misses']} misses · "
+                            f"{cache_stats['entries']} stored answers"
+                        )
+
+        # Tokens and cost of every model call of this session
+        with usage_col:
+            meter = session_meter()
+            totals = meter.totals()
+            if totals:
+                with st.expander("💰 Usage"):
+                    st.caption(usage_caption(totals))
+                    st.dataframe(meter.by_provider(), hide_index=True)
+                    ste.download_button("📊 Download Usage (CSV)", meter.export_csv(), "pearl_usage.csv", mime="text/csv")
+                    speculation = speculator.report()
+                    if speculation["spent"]:
+                        st.caption(
+                            f"Speculative answers: {speculation['used']['answers']} used · "
+                            f"{speculation['discarded']['answers']} discarded ({speculation['discarded']['tokens']} tokens, "
+                            f"${speculation['discarded']['cost_usd']:.4f}) · {speculation['spent']} of {speculation['budget']} tokens spent"
+                        )
+
+chat_area(stream_responses, compare_mode, use_response_cache, budget_history, recall_turns, speculate, fallback_models, hedge_after)
+if speculate and not compare_mode:
+    suggestion_poller()
+
+# Diagnostics: provider SDKs are imported when a model is first used, this shows what they cost
+phase("diagnostics")
+with st.sidebar:
+    with st.expander("Diagnostics"):
+        report = import_report()
+        if report:
+            st.dataframe(report, hide_index=True)
+            st.caption(f"Provider SDK import time in this server process (budget {IMPORT_BUDGET:g} s per module)")
+        else:
+            st.caption("No provider SDK loaded yet")
+        pools = pool_report()
+        if pools:
+            st.dataframe(pools, hide_index=True)
+            st.caption("Shared HTTP connection pools: requests sent and connections opened per API host")
+        scheduler_stats = get_scheduler().stats()
+        st.caption(
+            f"Model calls: {scheduler_stats['running']} running · {scheduler_stats['waiting']} waiting "
+            f"from {scheduler_stats['sessions_waiting']} sessions"
+        )
+        providers_usage, top_sessions = get_usage_ledger().report()
+        if providers_usage:
+            st.dataframe(providers_usage, hide_index=True)
+            st.caption("Model usage of this server process per provider")
+            st.dataframe(top_sessions, hide_index=True)
+            st.caption("Sessions with the most input tokens (a growing largest_prompt means a ballooning history)")
+        personas = get_persona_cache().stats()
+        st.caption(f"Compiled personas: {personas['entries']} shared · {personas['hits']} reused · {personas['misses']} compiled")
+        if session_spill:
+            spill = session_spill.report()
+            st.caption(
+                f"Sessions: {spill['sessions']} · {spill['resident_mb']} MB of history in memory · "
+                f"{spill['spilled']} idle spilled to disk ({spill['spilled_mb']} MB compressed)"
             )
-            st.markdown(f"<small>Interview contains {len(conversations)} exchanges</small>", unsafe_allow_html=True)
-    st.markdown("</div>", unsafe_allow_html=True)
+
+# Rerun traces: the script's phases with the model calls, failover attempts and memory updates inside them
+finish_trace()
+if tracing_enabled():
+    with st.sidebar:
+        with st.expander("🐞 Rerun trace"):
+            traces = list(reversed(st.session_state.get("traces", [])))
+            if traces:
+                #Widget values are copied, so the select box picks an index rather than the trace
+                index = st.selectbox(
+                    "Rerun",
+                    range(len(traces)),
+                    format_func=lambda i: f"{traces[i].root.name} · {(traces[i].root.end - traces[i].root.start) / 1e6:.0f} ms",
+                )
+                trace = traces[index]
+                show_waterfall(trace)
+                st.caption(f"Trace {trace.trace_id} (also written to the trace file)")
+            else:
+                st.caption("No rerun traced yet")
 
 # Footer
 
@@ -1,18 +1,22 @@
 #external libraries
-import openai
 import streamlit as st
 import streamlit_ext as ste
 import json
 
 #langchain libraries
 from langchain.chains import ConversationChain 
-from langchain.chains.conversation.memory import  ConversationBufferMemory, ConversationSummaryMemory, CombinedMemory
+from langchain.chains.conversation.memory import  ConversationBufferMemory, CombinedMemory
 from langchain.prompts import PromptTemplate
-from langchain.llms import OpenAI
 
 #Python libraries
-import os
-from dotenv import load_dotenv, set_key, find_dotenv
+import httpx
+
+from chat_memory import BackgroundSummaryMemory
+from credentials import session_credentials, validate_key
+from metering import metering, session_meter, show_usage
+from providers import get_client
+from session_spill import SESSION_SPILL, get_session_spill
+from streaming import run_chain
 
 
 #page setting
@@ -27,17 +31,20 @@ hide_st_style = """
 """
 #st.markdown(hide_st_style, unsafe_allow_html=True)
 
+#Earlier interviews kept by clear_chat (oldest are dropped)
+STORED_SESSIONS = 5
+
 #functions 
 def clear_chat():
     save = []
     for i in range(len(st.session_state['generated'])-1, -1, -1):
         save.append("Haman:" + st.session_state["past"][i])
         save.append("AI:" + st.session_state["generated"][i])
-    st.session_state["stored_session"].append(save)
-    st.session_state ["generated"] 
+    st.session_state["stored_session"] = (st.session_state["stored_session"] + [save])[-STORED_SESSIONS:]
+    st.session_state ["generated"] = []
     st.session_state["past"] = []
     st.session_state ["input"] = ""
-    st.session_state["entity_memory"] = CombinedMemory(memories=[ConversationBufferMemory(memory_key="chat_history_lines", input_key="input"), ConversationSummaryMemory(llm=llm, input_key="input")])
+    st.session_state["entity_memory"] = CombinedMemory(memories=[ConversationBufferMemory(memory_key="chat_history_lines", input_key="input"), BackgroundSummaryMemory(llm=llm, input_key="input", provider="openai")])
 
 def get_text():
     input_text = st.text_area("Human: ", st.session_state["input"], key="input", label_visibility='hidden')
@@ -72,6 +79,10 @@ st.sidebar.markdown(
 """
 )
 
+#Read back the history of a session that sat idle long enough to be spilled to disk
+if SESSION_SPILL:
+    get_session_spill().touch(["generated", "past", "stored_session", "entity_memory"])
+
 #API and Topic session states
 if "generated" not in st.session_state:
     st.session_state ["generated"] = []
@@ -90,19 +101,21 @@ st.subheader("Step 1:")
 st.subheader("Please input your OpenAI API key:")
 url = "https://help.openai.com/en/articles/4936850-where-do-i-find-my-secret-api-key"
 api = st.text_input("If you don't know your OpenAI API key click [here](%s)." % url, type="password", placeholder="Your API Key")
+#The key stays in this session's memory; it is never written to .env or os.environ
+credentials = session_credentials()
+credentials.set("openai", api)
 if st.button("Check key"):
     if api is not None:
-    #Delete any files in tempDir
         try:
-            # Send a test request to the OpenAI API
-            response = openai.Completion.create(
-                engine="text-davinci-003",
-                prompt="What is the capital of France?",
-                temperature=0.5
-            )
-            st.markdown("""---""")
-            st.success("API key is valid!")
-            st.warning("""
+            #Lists the models (no tokens spent); the result is cached per key for a while
+            valid, message = validate_key("openai", credentials.get("openai"))
+        except httpx.HTTPError as e:
+            st.error("Could not check the API key: {}".format(e))
+        else:
+            if valid:
+                st.markdown("""---""")
+                st.success(message)
+                st.warning("""
             **Instructions:** When creating a persona description for a chatbot to be interviewed by a researcher, consider the target audience and determine the age, gender, occupation, and personality traits of the persona. Use clear and concise language, avoid technical jargon, and keep the tone and voice consistent throughout the description.
 
             **Example Persona Description:**
@@ -110,23 +123,14 @@ if st.button("Check key"):
             Katarina is a 40-year-old math teacher with a Master's degree in Mathematics Education. She has been teaching for 15 years and loves helping students understand math concepts. Katarina is patient and kind. 
 
             Once you are satisfied, click on Submit! """)
-            st.markdown("""---""")
-        except Exception as e:
-            st.error("API key is invalid: {}".format(e))
+                st.markdown("""---""")
+            else:
+                st.error("API key is invalid: {}".format(message))
 #st.markdown("""---""") 
 
-#API settings for langchain use
-env_path = find_dotenv()
-if env_path == "":
-    with open(".env", "w") as env_file:
-        env_file.write("# .env\n")
-        env_path = ".env"
-
-# Load .env file
-load_dotenv(dotenv_path=env_path)
-set_key(env_path, "OPENAI_API_KEY", api)
-openai.api_key = os.environ["OPENAI_API_KEY"] 
-
+#Step 2 needs the session's own key; without one the client would look for the server's
+if not credentials.get("openai"):
+    st.stop()
 
 #chatbot
 #st.divider()
@@ -136,10 +140,10 @@ placeholder_1.subheader("Step 2:")
 placeholder_2.subheader("Write the persona you'd like to interview in text-box 👇")
 
 
-#Creating converational memory
-llm = OpenAI(temperature=0.5, openai_api_key=api, model_name="gpt-3.5-turbo")
+#Creating converational memory (the summary is updated in the background)
+llm = get_client("openai", "gpt-3.5-turbo", credentials.get("openai"), temperature=0.5)
 conv_memory = ConversationBufferMemory(memory_key = "chat_history_lines", input_key = "input")
-summary_memory = ConversationSummaryMemory(llm=llm, input_key="input")
+summary_memory = BackgroundSummaryMemory(llm=llm, input_key="input", provider="openai")
 memory = CombinedMemory(memories = [conv_memory, summary_memory])
 
 if 'entity_memory' not in st.session_state:
@@ -175,7 +179,9 @@ if st.button("Submit"):
         with st.spinner("Responding..."):
             
             #message_log.append({"role": "user", "content": user_input})
-            output = conversation.run(input=user_input)
+            #The reply and the background summary update it triggers are metered
+            with metering(session_meter()):
+                output = run_chain(conversation, {"input": user_input}, provider="openai")
             #message_log.append({"role": "assistant", "content": output})
             #store the output
             st.session_state['past'].append(user_input)
@@ -192,6 +198,8 @@ if st.button("Submit"):
         conversations_str = json.dumps(conversations)
         formatted_output = format_transcript(conversations_str)
         ste.download_button("Download Chat", formatted_output, "chat.txt")
+
+show_usage(session_meter())
             
     
 
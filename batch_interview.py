@@ -0,0 +1,169 @@
+#Headless batch interview runner
+#Runs every persona in a file through every question script in another file,
+#concurrently, and writes one transcript per interview in the same format as
+#the "Download Transcript" button of app_chat.py.
+#
+#Usage:
+#   python batch_interview.py personas.txt questions.txt --model "GPT 4o" --concurrency 20 --rpm "GPT 4o=500" --output-dir transcripts
+#
+#Personas: .json/.jsonl (strings or {"name", "persona"} objects) or .txt with
+#one persona per paragraph. Question scripts: .json/.jsonl (lists of questions
+#or {"name", "questions"} objects) or .txt with one question per line and a
+#blank line between scripts.
+
+#langchain libraries
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.rate_limiters import InMemoryRateLimiter
+
+#Python libraries
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from dotenv import load_dotenv
+
+from persona_cache import compile_persona
+from providers import MODELS, DEFAULT_MODEL, get_llm
+from routing import MAX_RETRIES, RETRY_BACKOFF
+from streaming import chunk_text
+from transcript import format_exchanges
+
+
+#Requests per minute per model when --rpm does not name it
+DEFAULT_RPM = 60
+
+logger = logging.getLogger("batch_interview")
+
+
+#functions
+def _read_records(path):
+    """Return the records of a .json/.jsonl file, or the text of any other file."""
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    if path.endswith(".json"):
+        return json.loads(text)
+    if path.endswith(".jsonl"):
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    return text
+
+def load_personas(path):
+    """Return [(name, persona description)] from a personas file."""
+    records = _read_records(path)
+    if isinstance(records, str):
+        records = [block.strip() for block in re.split(r"\n\s*\n", records) if block.strip()]
+    personas = []
+    for i, record in enumerate(records, 1):
+        if isinstance(record, str):
+            personas.append((f"persona{i}", record))
+        else:
+            personas.append((record.get("name", f"persona{i}"), record["persona"]))
+    return personas
+
+def load_scripts(path):
+    """Return [(name, [questions])] from a question scripts file."""
+    records = _read_records(path)
+    if isinstance(records, str):
+        blocks = [block for block in re.split(r"\n\s*\n", records) if block.strip()]
+        records = [[line.strip() for line in block.splitlines() if line.strip()] for block in blocks]
+    scripts = []
+    for i, record in enumerate(records, 1):
+        if isinstance(record, list):
+            scripts.append((f"script{i}", record))
+        else:
+            scripts.append((record.get("name", f"script{i}"), record["questions"]))
+    return scripts
+
+def parse_rpm(values):
+    limits = {}
+    for value in values or []:
+        label, _, rpm = value.rpartition("=")
+        if label not in MODELS:
+            raise SystemExit(f"Unknown model in --rpm: {label}")
+        limits[label] = float(rpm)
+    return limits
+
+def slug(text):
+    return re.sub(r"[^A-Za-z0-9]+", "-", text).strip("-").lower()
+
+async def ask(llm, limiter, messages):
+    for retry in range(MAX_RETRIES + 1):
+        await limiter.aacquire()
+        try:
+            return chunk_text(await llm.ainvoke(messages))
+        except Exception as e:
+            if retry == MAX_RETRIES:
+                raise
+            logger.warning("Retrying after error: %s", e)
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** retry)
+
+async def run_interview(llm_model, persona, questions, limiter, semaphore):
+    """Run one interview and return its (question, answer) exchanges."""
+    prompt = compile_persona(persona).prompt(MODELS[llm_model]["provider"])
+    llm = get_llm(llm_model)
+    history = []
+    exchanges = []
+    async with semaphore:
+        for question in questions:
+            answer = await ask(llm, limiter, prompt.format_messages(chat_history=history, input=question))
+            history += [HumanMessage(content=question), AIMessage(content=answer)]
+            exchanges.append((question, answer))
+    return exchanges
+
+async def run_batch(personas, scripts, models, concurrency, rpm, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    semaphore = asyncio.Semaphore(concurrency)
+    limiters = {
+        label: InMemoryRateLimiter(requests_per_second=rpm.get(label, DEFAULT_RPM) / 60, max_bucket_size=max(1, rpm.get(label, DEFAULT_RPM) / 60))
+        for label in models
+    }
+
+    async def interview(llm_model, persona_name, persona, script_name, questions):
+        path = os.path.join(output_dir, f"{slug(persona_name)}__{slug(script_name)}__{slug(llm_model)}.txt")
+        started = time.perf_counter()
+        try:
+            exchanges = await run_interview(llm_model, persona, questions, limiters[llm_model], semaphore)
+        except Exception as e:
+            logger.error("%s failed: %s", path, e)
+            return False
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(format_exchanges(exchanges))
+        logger.info("%s (%d questions, %.1f s)", path, len(exchanges), time.perf_counter() - started)
+        return True
+
+    jobs = [
+        interview(llm_model, persona_name, persona, script_name, questions)
+        for llm_model in models
+        for persona_name, persona in personas
+        for script_name, questions in scripts
+    ]
+    results = await asyncio.gather(*jobs)
+    return sum(results), len(results)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run PEARL persona interviews without the Streamlit UI.")
+    parser.add_argument("personas", help="File of persona descriptions")
+    parser.add_argument("questions", help="File of question scripts")
+    parser.add_argument("--model", action="append", choices=list(MODELS), help=f"Model to interview (repeatable, default {DEFAULT_MODEL})")
+    parser.add_argument("--concurrency", type=int, default=10, help="Maximum number of interviews running at once")
+    parser.add_argument("--rpm", action="append", metavar="MODEL=RPM", help=f"Requests per minute for a model (default {DEFAULT_RPM})")
+    parser.add_argument("--output-dir", default="transcripts", help="Directory for the transcripts")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    #The shared client cache warns when it runs outside a Streamlit server
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    load_dotenv()
+    personas = load_personas(args.personas)
+    scripts = load_scripts(args.questions)
+    models = args.model or [DEFAULT_MODEL]
+    started = time.perf_counter()
+    done, total = asyncio.run(run_batch(personas, scripts, models, args.concurrency, parse_rpm(args.rpm), args.output_dir))
+    logger.info("%d of %d interviews written to %s in %.1f s", done, total, args.output_dir, time.perf_counter() - started)
+    return 0 if done == total else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,283 @@
+#Conversation memories for long PEARL interviews
+
+#langchain libraries
+from langchain.memory import ConversationBufferMemory, ConversationSummaryMemory
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain_core.messages import HumanMessage, SystemMessage, get_buffer_string
+from pydantic import PrivateAttr
+
+#Python libraries
+import contextvars
+import logging
+import os
+import re
+import threading
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from metering import metered_as
+from retrieval import TurnIndex
+from scheduler import estimate_tokens, get_scheduler, in_background
+from tracing import span
+from tokens import count_tokens
+
+
+#Older turns are condensed to their first sentence, cut to this many words
+DIGEST_WORDS_PER_MESSAGE = 30
+
+#Retrieval memory: earlier exchanges recalled per question, and latest turns kept word for word
+RETRIEVAL_TOP_K = int(os.getenv("PEARL_RETRIEVAL_TOP_K", "4"))
+RETRIEVAL_RECENT_TURNS = int(os.getenv("PEARL_RETRIEVAL_RECENT_TURNS", "6"))
+
+#Summaries are brought up to date off the request path on a small shared pool
+SUMMARY_WORKERS = int(os.getenv("PEARL_SUMMARY_WORKERS", "4"))
+_summary_executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix="pearl-summary")
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBudgetMemory(ConversationBufferMemory):
+    """Buffer memory that keeps only the latest turns within a token budget.
+
+    The first pinned_messages messages (e.g. a persona stored in the history)
+    are always kept verbatim. Turns that no longer fit are condensed into a
+    short digest with its own budget, so the prompt size stays flat however
+    long the interview gets. The full history stays in chat_memory.
+    """
+
+    max_token_limit: int = 4000
+    digest_token_limit: int = 500
+    model: str = "gpt-4o"
+    pinned_messages: int = 0
+    _token_counts: list = PrivateAttr(default_factory=list)
+
+    def _message_tokens(self, messages):
+        #Token counts are cached per message object so each turn only tokenizes new messages
+        counts = self._token_counts
+        if len(counts) > len(messages) or (counts and counts[-1][0] is not messages[len(counts) - 1]):
+            counts.clear()
+        for message in messages[len(counts):]:
+            counts.append((message, count_tokens(self._buffer_as_str([message]), self.model)))
+        return [tokens for _, tokens in counts]
+
+    def _digest(self, messages):
+        lines = []
+        budget = self.digest_token_limit
+        for message in reversed(messages):
+            text = re.split(r"(?<=[.!?])\s", message.content.strip(), maxsplit=1)[0]
+            words = text.split()
+            if len(words) > DIGEST_WORDS_PER_MESSAGE:
+                text = " ".join(words[:DIGEST_WORDS_PER_MESSAGE]) + "..."
+            line = self._buffer_as_str([message.__class__(content=text)])
+            tokens = count_tokens(line, self.model)
+            if tokens > budget:
+                break
+            budget -= tokens
+            lines.append(line)
+        omitted = len(messages) - len(lines)
+        header = "Earlier in the interview (condensed"
+        header += f", {omitted} older messages omitted):" if omitted else "):"
+        return "\n".join([header] + lines[::-1])
+
+    @property
+    def budgeted_messages(self):
+        messages = self.chat_memory.messages
+        counts = self._message_tokens(messages)
+        pinned = min(self.pinned_messages, len(messages))
+        budget = self.max_token_limit - sum(counts[:pinned])
+        start = len(messages)
+        while start > pinned and counts[start - 1] <= budget:
+            budget -= counts[start - 1]
+            start -= 1
+        if start == pinned:
+            return messages
+        #Start the verbatim window on a question so the turns keep alternating
+        while start < len(messages) and not isinstance(messages[start], HumanMessage):
+            start += 1
+        digest = SystemMessage(content=self._digest(messages[pinned:start]))
+        return messages[:pinned] + [digest] + messages[start:]
+
+    @property
+    def buffer_as_str(self):
+        return get_buffer_string(
+            self.budgeted_messages,
+            human_prefix=self.human_prefix,
+            ai_prefix=self.ai_prefix,
+        )
+
+    @property
+    def buffer_as_messages(self):
+        return self.budgeted_messages
+
+
+class RetrievalMemory(TokenBudgetMemory):
+    """Token budget memory that recalls the relevant earlier exchanges instead of a digest.
+
+    Every exchange is added to a local TF-IDF index once it is saved. While
+    the whole interview fits in the token budget it is sent as is; after that
+    the prompt gets the latest recent_turns exchanges word for word (within the
+    token budget) and, from the turns before them, the top_k exchanges most
+    similar to the new question, in interview order. Facts the persona stated
+    hundreds of turns ago stay available without resending the whole interview.
+    """
+
+    top_k: int = RETRIEVAL_TOP_K
+    recent_turns: int = RETRIEVAL_RECENT_TURNS
+    _index = PrivateAttr(default_factory=TurnIndex)
+    #Position of the first message of every indexed exchange, and of the first message not indexed yet
+    _turns: list = PrivateAttr(default_factory=list)
+    _indexed: int = PrivateAttr(default=0)
+    _last_indexed = PrivateAttr(default=None)
+    _query: str = PrivateAttr(default="")
+
+    def _update_index(self, messages, pinned):
+        #Only exchanges saved since the last call are added; a cleared or replaced history is reindexed
+        if len(messages) < self._indexed or (self._indexed and messages[self._indexed - 1] is not self._last_indexed):
+            self._index, self._turns, self._indexed = TurnIndex(), [], 0
+        position = max(self._indexed, pinned)
+        while position < len(messages):
+            end = position + 1
+            while end < len(messages) and not isinstance(messages[end], HumanMessage):
+                end += 1
+            if end == position + 1 and end == len(messages):
+                #A question still waiting for its answer
+                break
+            self._index.add(self._buffer_as_str(messages[position:end]))
+            self._turns.append(position)
+            position = end
+        self._indexed = position
+        self._last_indexed = messages[position - 1] if position else None
+
+    def _recall(self, messages, before):
+        with span("memory.retrieve", turns=len(self._turns)):
+            hits = self._index.search(self._query, self.top_k, before=before)
+        lines = []
+        budget = self.digest_token_limit
+        for row, _ in hits:
+            end = self._turns[row + 1] if row + 1 < len(self._turns) else self._indexed
+            line = self._buffer_as_str(messages[self._turns[row]:end])
+            tokens = count_tokens(line, self.model)
+            if tokens <= budget:
+                budget -= tokens
+                lines.append((row, line))
+        if not lines:
+            return None
+        header = f"Earlier in the interview (the {len(lines)} of {before} earlier exchanges most relevant to the new question):"
+        return "\n".join([header] + [line for _, line in sorted(lines)])
+
+    @property
+    def budgeted_messages(self):
+        messages = self.chat_memory.messages
+        pinned = min(self.pinned_messages, len(messages))
+        self._update_index(messages, pinned)
+        counts = self._message_tokens(messages)
+        if sum(counts) <= self.max_token_limit:
+            #The whole interview fits: nothing to recall
+            return messages
+        budget = self.max_token_limit - sum(counts[:pinned])
+        floor = self._turns[-self.recent_turns] if 0 < self.recent_turns < len(self._turns) else pinned
+        start = len(messages)
+        while start > floor and counts[start - 1] <= budget:
+            budget -= counts[start - 1]
+            start -= 1
+        if start == pinned:
+            return messages
+        while start < len(messages) and not isinstance(messages[start], HumanMessage):
+            start += 1
+        recalled = self._recall(messages, bisect_left(self._turns, start))
+        if recalled is None:
+            #Nothing related to the question: fall back to the condensed digest
+            recalled = self._digest(messages[pinned:start])
+        return messages[:pinned] + [SystemMessage(content=recalled)] + messages[start:]
+
+    def load_memory_variables(self, inputs):
+        #The new question is what earlier exchanges are ranked against
+        self._query = str(inputs.get(self.input_key or "input", ""))
+        return super().load_memory_variables(inputs)
+
+
+class BackgroundSummaryMemory(ConversationSummaryMemory):
+    """Summary memory that updates its summary on a background worker.
+
+    save_context only records the turn. A worker then folds every message
+    added since the last checkpoint into the summary with a single call, and
+    load_memory_variables returns the latest completed summary instead of
+    waiting for the new one.
+    Updates are background calls of the process-wide scheduler, so they
+    yield to interview turns; with a provider the update takes its slot
+    here (leave it unset for a chat model that schedules itself, such as a
+    RoutedChatModel).
+    """
+
+    provider: str = None
+    _checkpoint: int = PrivateAttr(default=0)
+    _generation: int = PrivateAttr(default=0)
+    _pending = PrivateAttr(default=None)
+    _lock = PrivateAttr(default_factory=threading.Lock)
+
+    def save_context(self, inputs, outputs):
+        BaseChatMemory.save_context(self, inputs, outputs)
+        with self._lock:
+            #A running worker picks up the new turn before it finishes
+            if self._pending is None:
+                #The update is metered to the session whose turn triggered it
+                self._pending = _summary_executor.submit(contextvars.copy_context().run, self._summarize)
+
+    def _summarize(self):
+        while True:
+            with self._lock:
+                generation = self._generation
+                messages = self.chat_memory.messages[self._checkpoint:]
+                summary = self.buffer
+                if not messages:
+                    self._pending = None
+                    return
+            try:
+                with metered_as("summary"), in_background(), span("memory.summarize"), self._slot(messages, summary):
+                    new_summary = self.predict_new_summary(messages, summary)
+            except Exception:
+                logger.exception("Updating the conversation summary failed")
+                with self._lock:
+                    self._pending = None
+                return
+            with self._lock:
+                #Results computed before a clear() are dropped
+                if generation == self._generation:
+                    self.buffer = new_summary
+                    self._checkpoint += len(messages)
+
+    def _slot(self, messages, summary):
+        if self.provider is None:
+            return nullcontext()
+        return get_scheduler().slot(self.provider, estimate_tokens(messages) + count_tokens(summary))
+
+    def wait(self, timeout=None):
+        """Block until the summary covers every saved turn (for scripts and tests)."""
+        pending = self._pending
+        if pending is not None:
+            pending.result(timeout)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._checkpoint = 0
+            super().clear()
+
+
+#functions
+def budgeted_memory(memory, enabled, model, max_token_limit, recall=False):
+    """Switch a buffer memory between full, token-budget and retrieval mode, keeping its history."""
+    kind = (RetrievalMemory if recall else TokenBudgetMemory) if enabled else ConversationBufferMemory
+    if type(memory) is not kind:
+        memory = kind(
+            memory_key=memory.memory_key,
+            input_key=memory.input_key,
+            chat_memory=memory.chat_memory,
+            return_messages=memory.return_messages,
+        )
+    if enabled:
+        memory.model = model
+        memory.max_token_limit = max_token_limit
+        memory.digest_token_limit = max(100, max_token_limit // 10)
+    return memory
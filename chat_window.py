@@ -0,0 +1,48 @@
+#Windowed chat rendering
+#Only the latest exchanges of an interview are drawn on each rerun; older ones
+#are paged in on demand. This keeps the render time and the websocket payload
+#of a rerun about the same for a 200 turn interview as for a short one.
+
+#external libraries
+import streamlit as st
+
+#Python libraries
+import os
+
+
+#Exchanges (question + answer) drawn per page, 0 draws the whole interview
+CHAT_WINDOW = int(os.getenv("PEARL_CHAT_WINDOW", "20"))
+
+
+#functions
+def visible_messages(messages, pages, window=CHAT_WINDOW):
+    """Return (hidden, shown): how many older messages are left out and the ones to draw."""
+    if window <= 0:
+        return 0, messages
+    hidden = max(0, len(messages) - 2 * window * pages)
+    return hidden, messages[hidden:]
+
+def _show_more(key):
+    st.session_state[key] += 1
+
+def _show_latest(key):
+    st.session_state[key] = 1
+
+def paged_messages(messages, key="chat_pages", window=CHAT_WINDOW):
+    """Return the messages to draw this rerun, with buttons to page older ones in and out."""
+    pages = st.session_state.setdefault(key, 1)
+    hidden, shown = visible_messages(messages, pages, window)
+    if hidden or pages > 1:
+        more_col, latest_col = st.columns(2)
+        with more_col:
+            if hidden:
+                st.button(
+                    f"⬆️ Show earlier messages ({hidden} hidden)",
+                    on_click=_show_more,
+                    args=(key,),
+                    key=f"{key}_more",
+                )
+        with latest_col:
+            if pages > 1:
+                st.button("Show latest only", on_click=_show_latest, args=(key,), key=f"{key}_latest")
+    return shown
@@ -0,0 +1,111 @@
+#Per-session API keys and cached key validation
+#Keys typed into the app are kept in the session's own credential holder: they
+#are never written to .env or os.environ, so sessions cannot overwrite each
+#other's keys. Validation lists the provider's models, which costs no tokens,
+#and the result is shared by all sessions for a while, keyed by a hash of the key.
+
+#external libraries
+import httpx
+import streamlit as st
+
+#Python libraries
+import hashlib
+import os
+import threading
+import time
+
+from http_pool import get_http_client
+
+
+#Seconds a validation result is reused
+KEY_VALIDATION_TTL = int(os.getenv("PEARL_KEY_VALIDATION_TTL", "3600"))
+
+#Cheapest authenticated request per provider: list (a page of) its models
+VALIDATION_REQUESTS = {
+    "openai": ("https://api.openai.com/v1/models", lambda key: {"Authorization": f"Bearer {key}"}),
+    "anthropic": ("https://api.anthropic.com/v1/models?limit=1", lambda key: {"x-api-key": key, "anthropic-version": "2023-06-01"}),
+    "google": ("https://generativelanguage.googleapis.com/v1beta/models?pageSize=1", lambda key: {"x-goog-api-key": key}),
+    "deepseek": ("https://api.deepseek.com/models", lambda key: {"Authorization": f"Bearer {key}"}),
+}
+VALIDATION_TIMEOUT = 10
+
+
+class SessionCredentials:
+    """API keys entered in one session, held in memory only."""
+
+    def __init__(self):
+        self._keys = {}
+
+    def set(self, provider, api_key):
+        api_key = (api_key or "").strip()
+        if api_key:
+            self._keys[provider] = api_key
+        else:
+            self._keys.pop(provider, None)
+
+    def get(self, provider):
+        return self._keys.get(provider)
+
+    def __repr__(self):
+        #Never show the keys themselves (st.write, logs)
+        return f"SessionCredentials(providers={sorted(self._keys)})"
+
+
+class KeyValidator:
+    def __init__(self, ttl=KEY_VALIDATION_TTL):
+        self.ttl = ttl
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def validate(self, provider, api_key):
+        """Return (valid, message) for a key, checking it with the provider at most once per TTL.
+
+        Network problems and provider errors other than a rejected key are
+        raised and not cached.
+        """
+        if provider not in VALIDATION_REQUESTS:
+            return True, "No validation needed"
+        if not api_key:
+            return False, "No API key entered"
+        fingerprint = key_fingerprint(provider, api_key)
+        now = time.time()
+        with self._lock:
+            cached = self._results.get(fingerprint)
+            if cached and cached[0] > now:
+                return cached[1]
+        url, headers = VALIDATION_REQUESTS[provider]
+        client = get_http_client(provider)
+        if client is not None:
+            response = client.get(url, headers=headers(api_key), timeout=VALIDATION_TIMEOUT)
+        else:
+            response = httpx.get(url, headers=headers(api_key), timeout=VALIDATION_TIMEOUT)
+        if response.status_code in (400, 401, 403):
+            result = (False, f"The key was rejected ({response.status_code})")
+        else:
+            response.raise_for_status()
+            result = (True, "API key is valid")
+        with self._lock:
+            #Drop expired results while we are here
+            self._results = {key: value for key, value in self._results.items() if value[0] > now}
+            self._results[fingerprint] = (now + self.ttl, result)
+        return result
+
+
+@st.cache_resource(show_spinner=False)
+def get_key_validator():
+    """Return the key validation cache shared by all sessions of this process."""
+    return KeyValidator()
+
+
+#functions
+def key_fingerprint(provider, api_key):
+    return hashlib.sha256(f"{provider}:{api_key}".encode("utf-8")).hexdigest()
+
+def session_credentials():
+    """Return the credential holder of the current session."""
+    if "credentials" not in st.session_state:
+        st.session_state.credentials = SessionCredentials()
+    return st.session_state.credentials
+
+def validate_key(provider, api_key):
+    return get_key_validator().validate(provider, api_key)
@@ -0,0 +1,67 @@
+#Offline fake chat model for load tests
+#Behaves like a provider from the app's point of view (streaming, usage
+#metadata, occasional errors) without any network access or API cost. Selected
+#as "Fake (offline)" in the model selector when PEARL_FAKE_PROVIDER=1.
+
+#langchain libraries
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, get_buffer_string
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+#Python libraries
+import os
+import random
+import time
+
+
+#Seconds before the first token, tokens generated per second, tokens per reply
+#and the share of calls that fail
+FAKE_LATENCY = float(os.getenv("PEARL_FAKE_LATENCY", "0.5"))
+FAKE_TOKENS_PER_SECOND = float(os.getenv("PEARL_FAKE_TOKENS_PER_SECOND", "50"))
+FAKE_OUTPUT_TOKENS = int(os.getenv("PEARL_FAKE_OUTPUT_TOKENS", "120"))
+FAKE_ERROR_RATE = float(os.getenv("PEARL_FAKE_ERROR_RATE", "0"))
+
+WORDS = (
+    "well honestly I think that my students would say the classroom is where "
+    "I feel most at home and every day brings something new to learn about"
+).split()
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model that answers with filler text at a configurable pace."""
+
+    latency: float = FAKE_LATENCY
+    tokens_per_second: float = FAKE_TOKENS_PER_SECOND
+    output_tokens: int = FAKE_OUTPUT_TOKENS
+    error_rate: float = FAKE_ERROR_RATE
+
+    @property
+    def _llm_type(self):
+        return "pearl-fake"
+
+    def _get_ls_params(self, stop=None, **kwargs):
+        params = super()._get_ls_params(stop=stop, **kwargs)
+        params.update(ls_provider="fake", ls_model_name="fake")
+        return params
+
+    def _start(self, messages):
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            raise RuntimeError("Fake provider error")
+        input_tokens = len(get_buffer_string(messages)) // 4
+        words = [WORDS[i % len(WORDS)] for i in range(self.output_tokens)]
+        usage = {"input_tokens": input_tokens, "output_tokens": self.output_tokens, "total_tokens": input_tokens + self.output_tokens}
+        return words, usage
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        words, usage = self._start(messages)
+        time.sleep(len(words) / self.tokens_per_second)
+        message = AIMessage(content=" ".join(words), usage_metadata=usage)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        words, usage = self._start(messages)
+        for i, word in enumerate(words):
+            time.sleep(1 / self.tokens_per_second)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word if i == 0 else f" {word}"))
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=usage))
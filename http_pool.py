@@ -0,0 +1,117 @@
+#Shared keep-alive HTTP connection pools for the provider SDKs
+#Every OpenAI, Anthropic and DeepSeek client of the process sends its requests
+#through one httpx client per provider host, so TLS connections are reused
+#across turns, sessions and client rebuilds instead of being re-established.
+#HTTP/2 is used when the h2 package is installed. Gemini talks gRPC through its
+#own channel and is not pooled here.
+
+#external libraries
+import httpx
+import streamlit as st
+
+#Python libraries
+import importlib.util
+import os
+import threading
+import time
+
+
+PROVIDER_HOSTS = {
+    "openai": "api.openai.com",
+    "anthropic": "api.anthropic.com",
+    "deepseek": "api.deepseek.com",
+}
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("PEARL_HTTP_MAX_CONNECTIONS", "50"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("PEARL_HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("PEARL_HTTP_KEEPALIVE_EXPIRY", "120"))
+HTTP2 = os.getenv("PEARL_HTTP2", "1") != "0" and importlib.util.find_spec("h2") is not None
+#Same defaults as the OpenAI and Anthropic SDKs; they set their own per request
+HTTP_TIMEOUT = httpx.Timeout(600.0, connect=5.0)
+
+
+class PoolStats:
+    """Counts requests and newly opened connections of one pool."""
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.tls_handshakes = 0
+        self.handshake_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def on_request(self, request):
+        with self._lock:
+            self.requests += 1
+        #httpcore reports connection setup through the request's trace extension
+        connect_started = []
+
+        def trace(event, info):
+            if event == "connection.connect_tcp.started":
+                connect_started.append(time.perf_counter())
+                with self._lock:
+                    self.new_connections += 1
+            elif event in ("connection.start_tls.complete", "connection.start_tls.failed") and connect_started:
+                with self._lock:
+                    self.tls_handshakes += 1
+                    self.handshake_seconds += time.perf_counter() - connect_started.pop()
+
+        request.extensions.setdefault("trace", trace)
+
+    def as_dict(self):
+        with self._lock:
+            reused = self.requests - self.new_connections
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reuse_rate": round(reused / self.requests, 3) if self.requests else None,
+                "avg_handshake_ms": round(1000 * self.handshake_seconds / self.tls_handshakes, 1) if self.tls_handshakes else None,
+            }
+
+
+class HttpPools:
+    """One keep-alive httpx client per API host, created on first use."""
+
+    def __init__(self):
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def client(self, host):
+        with self._lock:
+            if host not in self._pools:
+                stats = PoolStats()
+                client = httpx.Client(
+                    http2=HTTP2,
+                    timeout=HTTP_TIMEOUT,
+                    limits=httpx.Limits(
+                        max_connections=HTTP_MAX_CONNECTIONS,
+                        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                    ),
+                    event_hooks={"request": [stats.on_request]},
+                )
+                self._pools[host] = (client, stats)
+            return self._pools[host][0]
+
+    def report(self):
+        with self._lock:
+            pools = list(self._pools.items())
+        return [{"host": host, "http2": HTTP2, **stats.as_dict()} for host, (client, stats) in pools]
+
+
+@st.cache_resource(show_spinner=False)
+def get_http_pools():
+    """Return the connection pools shared by all sessions of this process."""
+    return HttpPools()
+
+
+#functions
+def get_http_client(provider):
+    """Return the shared httpx client for a provider's API host (None if it is not pooled)."""
+    if provider not in PROVIDER_HOSTS:
+        return None
+    return get_http_pools().client(PROVIDER_HOSTS[provider])
+
+def pool_report():
+    """Return the connection reuse of every pool opened so far, for the diagnostics view."""
+    return get_http_pools().report()
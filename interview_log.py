@@ -0,0 +1,140 @@
+#Durable interview log
+#Every completed turn is appended to a per-session JSONL file (.pearl/sessions/)
+#by a background writer thread, so the page never waits on the disk. Records are
+#written in batches and optionally fsync'ed. A session can be resumed from its
+#log by ID (the ?session= query parameter) after a browser refresh or a server
+#restart; the interview is rebuilt from the recorded answers, no LLM is called.
+
+#external libraries
+import streamlit as st
+
+#Python libraries
+import atexit
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+
+
+INTERVIEW_LOG = os.getenv("PEARL_INTERVIEW_LOG", "1") != "0"
+INTERVIEW_LOG_DIR = os.getenv("PEARL_INTERVIEW_LOG_DIR", os.path.join(os.getenv("PEARL_DATA_DIR", ".pearl"), "sessions"))
+#Seconds the writer waits to collect a batch of records
+INTERVIEW_LOG_FLUSH_INTERVAL = float(os.getenv("PEARL_INTERVIEW_LOG_FLUSH_INTERVAL", "0.5"))
+#fsync every batch (survives a machine crash, not only a process restart)
+INTERVIEW_LOG_FSYNC = os.getenv("PEARL_INTERVIEW_LOG_FSYNC", "0") == "1"
+
+SESSION_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+logger = logging.getLogger(__name__)
+
+
+#functions
+def new_session_id():
+    return uuid.uuid4().hex
+
+def valid_session_id(session_id):
+    return bool(session_id) and SESSION_ID_PATTERN.fullmatch(session_id) is not None
+
+def replay(records):
+    """Return (profile, turns) of an interview from its log records.
+
+    A "persona" record starts a new interview (Emulate Persona), each "turn"
+    record is one question with its answer (or answers, in comparison mode).
+    """
+    profile, turns = None, []
+    for record in records:
+        if record.get("type") == "persona":
+            profile, turns = record.get("profile", ""), []
+        elif record.get("type") == "turn":
+            turns.append(record)
+    return profile, turns
+
+
+class InterviewLog:
+    """Append-only JSONL log with one file per session and a batching writer thread."""
+
+    def __init__(self, directory=INTERVIEW_LOG_DIR, flush_interval=INTERVIEW_LOG_FLUSH_INTERVAL, fsync=INTERVIEW_LOG_FSYNC):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self._queue = queue.Queue()
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=self._run, name="interview-log", daemon=True).start()
+
+    def path(self, session_id):
+        if not valid_session_id(session_id):
+            raise ValueError(f"Invalid session ID: {session_id!r}")
+        return os.path.join(self.directory, f"{session_id}.jsonl")
+
+    def append(self, session_id, record_type, **fields):
+        """Queue a record for the session's log; returns immediately."""
+        record = {"type": record_type, "time": time.time(), **fields}
+        self._queue.put((self.path(session_id), record))
+
+    def flush(self):
+        """Block until every queued record is on disk."""
+        self._queue.join()
+
+    def exists(self, session_id):
+        if not valid_session_id(session_id):
+            return False
+        #The session's first records may still be waiting for the writer
+        self.flush()
+        return os.path.exists(self.path(session_id))
+
+    def load(self, session_id):
+        """Return the records logged for a session, oldest first."""
+        self.flush()
+        records = []
+        try:
+            with open(self.path(session_id), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        #A torn last line from a crash mid-write
+                        logger.warning("Skipping unreadable record in session %s", session_id)
+        except FileNotFoundError:
+            pass
+        return records
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while (timeout := deadline - time.monotonic()) > 0:
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception:
+                logger.exception("Could not write %d interview log records", len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch):
+        lines = {}
+        for path, record in batch:
+            lines.setdefault(path, []).append(json.dumps(record, ensure_ascii=False) + "\n")
+        for path, records in lines.items():
+            with open(path, "a", encoding="utf-8") as f:
+                f.writelines(records)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+
+
+@st.cache_resource(show_spinner=False)
+def get_interview_log():
+    """Return the interview log shared by all sessions of this process."""
+    log = InterviewLog()
+    #Write the last batch before the server exits (e.g. a restart for a deploy)
+    atexit.register(log.flush)
+    return log
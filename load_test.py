@@ -0,0 +1,168 @@
+#Offline load test for app_chat.py
+#Drives many simulated sessions through the real app script (Streamlit's app
+#testing API) against the fake provider, several at once in worker processes,
+#and reports per-rerun latency percentiles, throughput and memory per session. Needs no network or API keys,
+#so it can gate a deploy.
+#
+#Usage:
+#   python load_test.py --sessions 50 --turns 5 --latency 0.5 --tokens-per-second 50 --output-tokens 120
+#   python load_test.py --sessions 50 --max-p95 3 --max-error-rate 0.01   (exit code 1 when a limit is exceeded)
+
+#Python libraries
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+PERSONA = (
+    "Katarina is a 40-year-old math teacher with a Master's degree in Mathematics Education. "
+    "She has been teaching for 15 years and loves helping students understand math concepts."
+)
+QUESTION = "Question {turn} from session {session}: what do you enjoy most about teaching?"
+FAKE_MODEL = "Fake (offline)"
+
+logger = logging.getLogger("load_test")
+
+#Finished sessions of a worker process, kept alive so their memory is counted
+_finished = []
+
+
+#functions
+def configure(args):
+    """Point the app at the fake provider and a scratch data directory (before it is imported)."""
+    os.environ.update({
+        "PEARL_FAKE_PROVIDER": "1",
+        "PEARL_FAKE_LATENCY": str(args.latency),
+        "PEARL_FAKE_TOKENS_PER_SECOND": str(args.tokens_per_second),
+        "PEARL_FAKE_OUTPUT_TOKENS": str(args.output_tokens),
+        "PEARL_FAKE_ERROR_RATE": str(args.error_rate),
+        "PEARL_DATA_DIR": args.data_dir or tempfile.mkdtemp(prefix="pearl-load-"),
+        #Every simulated session runs outside a Streamlit server, which it warns about
+        "STREAMLIT_LOGGER_LEVEL": "error",
+    })
+
+def _init_worker(script):
+    #The app modules are imported from the script's directory, as streamlit run would
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def run_session(script, session, turns, timeout):
+    """Run one simulated interview; return its rerun timings and the worker's memory afterwards."""
+    from streamlit.testing.v1 import AppTest
+
+    app = AppTest.from_file(script, default_timeout=timeout)
+    result = {"setup": [], "turns": [], "errors": 0}
+
+    def rerun(timings):
+        started = time.perf_counter()
+        app.run()
+        timings.append(time.perf_counter() - started)
+        return len(app.exception) + len(app.error)
+
+    rerun(result["setup"])
+    app.selectbox(key="llm_model").select(FAKE_MODEL)
+    rerun(result["setup"])
+    app.text_area(key="profile").input(PERSONA)
+    rerun(result["setup"])
+    next(button for button in app.button if "Emulate" in button.label).click()
+    rerun(result["setup"])
+    for turn in range(1, turns + 1):
+        app.chat_input(key="chat_input").set_value(QUESTION.format(turn=turn, session=session))
+        if rerun(result["turns"]):
+            result["errors"] += 1
+    _finished.append(app)
+    result.update(worker=os.getpid(), rss_mb=peak_rss_mb())
+    return result
+
+def memory_per_session(results):
+    """Return the average RSS growth per additional session of a worker (MB), or None."""
+    workers = {}
+    for result in results:
+        workers.setdefault(result["worker"], []).append(result["rss_mb"])
+    #The first session of a worker also pays for importing the app, so it is the baseline
+    growth = [(max(rss) - rss[0], len(rss) - 1) for rss in workers.values() if len(rss) > 1]
+    sessions = sum(count for _, count in growth)
+    return round(sum(mb for mb, _ in growth) / sessions, 2) if sessions else None
+
+def run_load_test(script, sessions, turns, workers, timeout):
+    #AppTest swaps a process-global runtime on every run, so concurrent sessions
+    #need their own processes; each worker drives its sessions one after another
+    #AppTest also replaces __main__ with the app script, so the worker functions
+    #are sent to the processes by their module name
+    import load_test
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=load_test._init_worker, initargs=(script,)) as pool:
+        futures = [pool.submit(load_test.run_session, script, session, turns, timeout) for session in range(1, sessions + 1)]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+    turn_times = [seconds for result in results for seconds in result["turns"]]
+    setup_times = [seconds for result in results for seconds in result["setup"]]
+    errors = sum(result["errors"] for result in results)
+    return {
+        "sessions": sessions,
+        "workers": workers,
+        "turns": len(turn_times),
+        "elapsed_s": round(elapsed, 2),
+        "throughput_turns_per_s": round(len(turn_times) / elapsed, 2),
+        "turn_rerun_s": {f"p{p}": round(percentile(turn_times, p), 3) for p in (50, 90, 95, 99, 100)},
+        "other_rerun_s": {f"p{p}": round(percentile(setup_times, p), 3) for p in (50, 95)},
+        "errors": errors,
+        "error_rate": round(errors / len(turn_times), 4) if turn_times else 0,
+        "rss_mb_per_session": memory_per_session(results),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test app_chat.py offline with simulated sessions and a fake provider.")
+    parser.add_argument("--script", default="app_chat.py", help="App script to drive")
+    parser.add_argument("--sessions", type=int, default=20, help="Simulated sessions")
+    parser.add_argument("--turns", type=int, default=5, help="Questions per session")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Sessions running at once, one per process")
+    parser.add_argument("--latency", type=float, default=0.5, help="Fake provider seconds to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="Fake provider generation speed")
+    parser.add_argument("--output-tokens", type=int, default=120, help="Fake provider reply length")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of fake provider calls that fail")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds a single rerun may take")
+    parser.add_argument("--data-dir", help="Directory for logs and caches (default: a new temporary directory)")
+    parser.add_argument("--max-p95", type=float, help="Fail if the 95th percentile turn rerun takes longer (seconds)")
+    parser.add_argument("--max-error-rate", type=float, help="Fail if more turns than this share end in an error")
+    parser.add_argument("--json", help="Also write the report to this file")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(message)s")
+    logger.setLevel(logging.INFO)
+    configure(args)
+    logger.info("Running %d sessions x %d turns against %s in %d processes", args.sessions, args.turns, args.script, args.workers)
+    report = run_load_test(args.script, args.sessions, args.turns, args.workers, args.timeout)
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    failures = []
+    if args.max_p95 is not None and report["turn_rerun_s"]["p95"] > args.max_p95:
+        failures.append(f"p95 turn rerun {report['turn_rerun_s']['p95']} s > {args.max_p95} s")
+    if args.max_error_rate is not None and report["error_rate"] > args.max_error_rate:
+        failures.append(f"error rate {report['error_rate']} > {args.max_error_rate}")
+    for failure in failures:
+        logger.error("Load test failed: %s", failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
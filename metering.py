@@ -0,0 +1,263 @@
+#Token and cost metering
+#Every model call made while a session's meter is active (replies, comparison
+#replies, failover attempts and the background summary updates of summary
+#memories) is recorded with its input, output and cached tokens, latency,
+#provider and model. The meter is a langchain callback handler injected through
+#a context variable, so chains and memories need no extra arguments. Totals are
+#kept per session and per provider, and for the whole process in the usage ledger.
+
+#external libraries
+import streamlit as st
+import streamlit_ext as ste
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+#langchain libraries
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.tracers.context import register_configure_hook
+
+#Python libraries
+import contextvars
+import csv
+import io
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from providers import MODELS
+
+
+#List prices in USD per million tokens: (input, cached input, output)
+PRICES = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4-turbo": (10.00, 10.00, 30.00),
+    "gpt-4": (30.00, 30.00, 60.00),
+    "gpt-3.5-turbo": (0.50, 0.50, 1.50),
+    "claude-3-7-sonnet-20250219": (3.00, 0.30, 15.00),
+    "gemini-2.0-flash": (0.10, 0.025, 0.40),
+    "deepseek-chat": (0.27, 0.07, 1.10),
+}
+#Sessions the process-wide ledger keeps totals for
+LEDGER_SESSIONS = 1000
+CSV_COLUMNS = ["session", "time", "purpose", "provider", "model", "input_tokens", "cached_tokens", "output_tokens", "latency_s", "cost_usd", "error"]
+
+#Provider of each model of the selector; langchain reports some under another name
+MODEL_PROVIDERS = {spec["model"]: spec["provider"] for spec in MODELS.values()}
+LS_PROVIDERS = {"google_genai": "google"}
+
+#Meter of the current turn, and what its calls are for ("reply", "summary", ...)
+usage_meter = contextvars.ContextVar("usage_meter", default=None)
+usage_purpose = contextvars.ContextVar("usage_purpose", default="reply")
+
+
+def call_cost(model, input_tokens, cached_tokens, output_tokens):
+    """Return the list price of a call in USD (None for models without a price)."""
+    if model not in PRICES:
+        return None
+    input_price, cached_price, output_price = PRICES[model]
+    uncached = max(0, input_tokens - cached_tokens)
+    return (uncached * input_price + cached_tokens * cached_price + output_tokens * output_price) / 1e6
+
+
+def _usage(response):
+    #(input, cached, output) tokens of an LLMResult, from chat message usage or the llm output
+    input_tokens = cached_tokens = output_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                input_tokens += usage.get("input_tokens") or 0
+                output_tokens += usage.get("output_tokens") or 0
+                cached_tokens += (usage.get("input_token_details") or {}).get("cache_read") or 0
+    if not (input_tokens or output_tokens):
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        input_tokens = token_usage.get("prompt_tokens") or 0
+        output_tokens = token_usage.get("completion_tokens") or 0
+        cached_tokens = (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    return input_tokens, cached_tokens, output_tokens
+
+
+class UsageMeter(BaseCallbackHandler):
+    """Records the model calls of one session."""
+
+    def __init__(self, session=None, ledger=None):
+        self.session = session
+        self.ledger = ledger
+        self.records = []
+        self._runs = {}
+        self._lock = threading.Lock()
+
+    def _start(self, serialized, run_id, metadata, kwargs):
+        params = kwargs.get("invocation_params") or {}
+        #The failover wrapper is not a call of its own; its attempts are metered
+        if params.get("_type") == "pearl-routed":
+            return
+        metadata = metadata or {}
+        model = (metadata.get("ls_model_name") or params.get("model_name") or params.get("model") or "").removeprefix("models/")
+        provider = MODEL_PROVIDERS.get(model) or LS_PROVIDERS.get(metadata.get("ls_provider"), metadata.get("ls_provider"))
+        with self._lock:
+            self._runs[run_id] = (time.perf_counter(), provider, model, usage_purpose.get())
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        self._start(serialized, run_id, metadata, kwargs)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, **kwargs):
+        self._start(serialized, run_id, metadata, kwargs)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._finish(run_id, *_usage(response))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, 0, 0, 0, error=type(error).__name__)
+
+    def _finish(self, run_id, input_tokens, cached_tokens, output_tokens, error=""):
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        started, provider, model, purpose = run
+        cost = call_cost(model, input_tokens, cached_tokens, output_tokens)
+        record = {
+            "session": self.session,
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "purpose": purpose,
+            "provider": provider,
+            "model": model,
+            "input_tokens": input_tokens,
+            "cached_tokens": cached_tokens,
+            "output_tokens": output_tokens,
+            "latency_s": round(time.perf_counter() - started, 3),
+            "cost_usd": round(cost, 6) if cost is not None else None,
+            "error": error,
+        }
+        with self._lock:
+            self.records.append(record)
+        if self.ledger is not None:
+            self.ledger.add(record)
+
+    def by_provider(self):
+        """Return the totals of this session per provider and model."""
+        with self._lock:
+            return _totals(self.records, ("provider", "model"))
+
+    def totals(self):
+        """Return the totals of this session (None before its first call)."""
+        with self._lock:
+            totals = _totals(self.records, ())
+        return totals[0] if totals else None
+
+    def export_csv(self):
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS)
+        writer.writeheader()
+        with self._lock:
+            writer.writerows(self.records)
+        return buffer.getvalue()
+
+
+def _totals(records, keys):
+    groups = {}
+    for record in records:
+        group = groups.setdefault(tuple(record.get(key) for key in keys), {
+            **{key: record.get(key) for key in keys},
+            "calls": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "latency_s": 0.0, "cost_usd": 0.0,
+        })
+        group["calls"] += 1
+        for field in ("input_tokens", "cached_tokens", "output_tokens", "latency_s"):
+            group[field] += record[field]
+        group["cost_usd"] += record["cost_usd"] or 0
+    for group in groups.values():
+        group["latency_s"] = round(group["latency_s"], 3)
+        group["cost_usd"] = round(group["cost_usd"], 4)
+    return list(groups.values())
+
+
+class UsageLedger:
+    """Usage totals of the whole process, per session and per provider."""
+
+    def __init__(self, max_sessions=LEDGER_SESSIONS):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._providers = {}
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            for totals, key in ((self._sessions, record["session"]), (self._providers, record["provider"])):
+                entry = totals.setdefault(key, {"calls": 0, "input_tokens": 0, "output_tokens": 0, "cost_usd": 0.0, "largest_prompt": 0})
+                entry["calls"] += 1
+                entry["input_tokens"] += record["input_tokens"]
+                entry["output_tokens"] += record["output_tokens"]
+                entry["cost_usd"] += record["cost_usd"] or 0
+                #A prompt that keeps growing shows up here first
+                entry["largest_prompt"] = max(entry["largest_prompt"], record["input_tokens"])
+            self._sessions.move_to_end(record["session"])
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def report(self, top=10):
+        """Return (providers, sessions): provider totals and the top sessions by input tokens."""
+        with self._lock:
+            providers = [{"provider": key, **entry} for key, entry in self._providers.items()]
+            sessions = sorted(
+                ({"session": key, **entry} for key, entry in self._sessions.items()),
+                key=lambda entry: entry["input_tokens"],
+                reverse=True,
+            )[:top]
+        for entry in providers + sessions:
+            entry["cost_usd"] = round(entry["cost_usd"], 4)
+        return providers, sessions
+
+
+@st.cache_resource(show_spinner=False)
+def get_usage_ledger():
+    """Return the usage ledger shared by all sessions of this process."""
+    return UsageLedger()
+
+
+#Every callback manager configured while a meter is active reports to it
+register_configure_hook(usage_meter, inheritable=True)
+
+
+#functions
+def session_meter():
+    """Return the usage meter of the current session."""
+    if "usage_meter" not in st.session_state:
+        ctx = get_script_run_ctx()
+        session = st.session_state.get("session_id") or (ctx.session_id if ctx else None)
+        st.session_state.usage_meter = UsageMeter(session, get_usage_ledger())
+    return st.session_state.usage_meter
+
+@contextmanager
+def metering(meter):
+    """Record the model calls made inside the block (and the work they hand to other threads) with meter."""
+    token = usage_meter.set(meter)
+    try:
+        yield meter
+    finally:
+        usage_meter.reset(token)
+
+@contextmanager
+def metered_as(purpose):
+    """Label the model calls made inside the block (e.g. "summary")."""
+    token = usage_purpose.set(purpose)
+    try:
+        yield
+    finally:
+        usage_purpose.reset(token)
+
+def usage_caption(totals):
+    return (
+        f"{totals['calls']} model calls · {totals['input_tokens']} input tokens "
+        f"({totals['cached_tokens']} cached) · {totals['output_tokens']} output tokens · "
+        f"${totals['cost_usd']:.4f} at list prices"
+    )
+
+def show_usage(meter):
+    """Draw a session's usage in the sidebar, with its CSV export."""
+    totals = meter.totals()
+    if not totals:
+        return
+    st.sidebar.caption(usage_caption(totals))
+    st.sidebar.dataframe(meter.by_provider(), hide_index=True)
+    ste.sidebar.download_button("Download Usage (CSV)", meter.export_csv(), "usage.csv", mime="text/csv")
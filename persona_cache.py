@@ -0,0 +1,109 @@
+#Compiled personas shared by all sessions
+#"Emulate Persona" compiles a persona once: the profile is normalized and
+#rendered into the system block, which is hashed and token-counted, and the
+#chat prompt of each provider is built from it on first use. Compiled personas
+#live in a process-wide cache keyed by the hash, so a whole class interviewing
+#the instructor's persona shares one, and every turn reuses it instead of
+#formatting the instructions and building prompt objects again.
+
+#external libraries
+import streamlit as st
+
+#Python libraries
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from prompting import PERSONA_INSTRUCTIONS, PersonaChatPrompt
+from tokens import count_tokens
+
+
+PERSONA_CACHE_MAX_ENTRIES = int(os.getenv("PEARL_PERSONA_CACHE_MAX_ENTRIES", "256"))
+
+
+#functions
+def normalize_profile(profile):
+    """Trim every line, collapse runs of spaces and of blank lines."""
+    lines = [re.sub(r"[ \t]+", " ", line).strip() for line in (profile or "").strip().splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines))
+
+def persona_key(profile, instructions=PERSONA_INSTRUCTIONS):
+    return hashlib.sha256(f"{instructions}\0{normalize_profile(profile)}".encode("utf-8")).hexdigest()
+
+
+class CompiledPersona:
+    """A persona rendered into its system block, with what every turn needs from it."""
+
+    def __init__(self, profile, instructions=PERSONA_INSTRUCTIONS):
+        self.source = profile
+        self.profile = normalize_profile(profile)
+        self.instructions = instructions
+        self.system_block = instructions.format(profile=self.profile)
+        self.hash = persona_key(profile, instructions)
+        self.tokens = count_tokens(self.system_block)
+        self._model_tokens = {}
+        self._prompts = {}
+        self._lock = threading.Lock()
+
+    def token_count(self, model):
+        """Return the tokens of the system block for a provider model."""
+        if model not in self._model_tokens:
+            self._model_tokens[model] = count_tokens(self.system_block, model)
+        return self._model_tokens[model]
+
+    def prompt(self, provider):
+        """Return the chat prompt of this persona for a provider (shared, it holds no state)."""
+        with self._lock:
+            if provider not in self._prompts:
+                self._prompts[provider] = PersonaChatPrompt(
+                    instructions=self.instructions,
+                    profile=self.profile,
+                    system_block=self.system_block,
+                    provider=provider,
+                )
+            return self._prompts[provider]
+
+
+class PersonaCache:
+    """Compiled personas by hash, least recently used ones evicted first."""
+
+    def __init__(self, max_entries=PERSONA_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._personas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compile(self, profile, instructions=PERSONA_INSTRUCTIONS):
+        key = persona_key(profile, instructions)
+        with self._lock:
+            persona = self._personas.get(key)
+            if persona is not None:
+                self._personas.move_to_end(key)
+                self.hits += 1
+                return persona
+            self.misses += 1
+        persona = CompiledPersona(profile, instructions)
+        with self._lock:
+            #Another session may have compiled the same persona meanwhile
+            persona = self._personas.setdefault(key, persona)
+            while len(self._personas) > self.max_entries:
+                self._personas.popitem(last=False)
+        return persona
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._personas), "hits": self.hits, "misses": self.misses}
+
+
+@st.cache_resource(show_spinner=False)
+def get_persona_cache():
+    """Return the compiled persona cache shared by all sessions of this process."""
+    return PersonaCache()
+
+
+def compile_persona(profile, instructions=PERSONA_INSTRUCTIONS):
+    """Return the compiled persona for a profile, compiling it on first use in this process."""
+    return get_persona_cache().compile(profile, instructions)
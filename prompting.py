@@ -0,0 +1,114 @@
+#Prompt layout for provider-side prefix caching
+#The prompt is sent as structured messages ordered from most to least stable:
+#system instructions and persona, the turns sent word for word, and finally the
+#new question. Condensed or recalled older turns change whenever the memory
+#moves its window (recall changes with every question), so they travel with the
+#question instead of the system prompt. Everything before the question is then
+#byte-identical from one turn to the next while the window stays put, and
+#providers can serve it from their prompt cache.
+
+#langchain libraries
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.prompts.chat import BaseChatPromptTemplate
+
+
+#Providers that need explicit cache breakpoints (OpenAI, DeepSeek and Gemini cache
+#repeated prefixes automatically)
+CACHE_CONTROL_PROVIDERS = {"anthropic"}
+EPHEMERAL = {"type": "ephemeral"}
+
+#System instructions for a persona interview (app_chat.py and batch_interview.py)
+PERSONA_INSTRUCTIONS = """You are following persona: {profile}. Engage in conversations with a researcher. 
+Your main objective is to stay in character throughout the entire conversation, adapting to the persona's characteristics, mannerisms, and knowledge.
+Please provide a coherent, engaging, and in-character response to any questions or statements you receive. You are being interviewed by a researcher, so you should answer the questions in a way that is helpful to the researcher."""
+
+
+class PersonaChatPrompt(BaseChatPromptTemplate):
+    """Chat prompt for a persona interview with a cache-friendly layout.
+
+    instructions may contain {profile}. Messages at the start of the history
+    that come before the first question (e.g. a persona stored as the first AI
+    message) are moved into the system prompt, condensed-history system
+    messages go with the new question, and the remaining turns are sent as
+    user/assistant messages.
+    system_block is the instructions already rendered for a compiled persona
+    (see persona_cache); it replaces the persona messages of the history.
+    """
+
+    instructions: str
+    profile: str = ""
+    system_block: str = ""
+    provider: str = "openai"
+    input_variables: list = ["chat_history", "input"]
+
+    def format_messages(self, **kwargs):
+        persona_blocks = [self.system_block or self.instructions.format(profile=self.profile)]
+        condensed_blocks = []
+        history = kwargs.get("chat_history") or []
+        if isinstance(history, str):
+            condensed_blocks.append(f"Current conversation:\n{history}")
+            history = []
+        turns = []
+        for message in history:
+            if isinstance(message, SystemMessage):
+                condensed_blocks.append(message.content)
+            elif not turns and not isinstance(message, HumanMessage):
+                if not self.system_block:
+                    persona_blocks.append(message.content)
+            else:
+                turns.append(message)
+        return build_messages(persona_blocks, condensed_blocks, turns, kwargs["input"], self.provider)
+
+    @property
+    def _prompt_type(self):
+        return "persona-chat"
+
+
+#functions
+def _with_cache_marker(message):
+    #Copy the message so the marker never ends up in the stored history
+    content = message.content
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    content = [dict(block) for block in content]
+    content[-1]["cache_control"] = EPHEMERAL
+    return message.model_copy(update={"content": content})
+
+def build_messages(persona_blocks, condensed_blocks, turns, question, provider):
+    """Return [system, *turns, question] with cache breakpoints where supported.
+
+    persona_blocks never change during an interview. condensed_blocks (older
+    turns condensed or recalled by the memory) change as the history window
+    moves, so they are sent in the question's message after the cached prefix.
+    """
+    persona_blocks = [block for block in persona_blocks if block]
+    condensed_blocks = [block for block in condensed_blocks if block]
+    if provider in CACHE_CONTROL_PROVIDERS:
+        blocks = [{"type": "text", "text": block} for block in persona_blocks]
+        #Breakpoint after the persona, which never changes during an interview
+        blocks[-1]["cache_control"] = EPHEMERAL
+        system = SystemMessage(content=blocks)
+        if turns:
+            #Breakpoint after the previous turn, so the whole history is reused next turn
+            turns = turns[:-1] + [_with_cache_marker(turns[-1])]
+        content = [{"type": "text", "text": block} for block in condensed_blocks + [question]]
+        question = HumanMessage(content=content if condensed_blocks else question)
+    else:
+        system = SystemMessage(content="\n\n".join(persona_blocks))
+        question = HumanMessage(content="\n\n".join(condensed_blocks + [question]))
+    return [system, *turns, question]
+
+def adapt_messages(messages, provider):
+    """Drop cache breakpoints from messages sent to a provider that does not use them."""
+    if provider in CACHE_CONTROL_PROVIDERS:
+        return messages
+    adapted = []
+    for message in messages:
+        if isinstance(message.content, list):
+            text = "\n\n".join(
+                block if isinstance(block, str) else block.get("text", "")
+                for block in message.content
+            )
+            message = message.model_copy(update={"content": text})
+        adapted.append(message)
+    return adapted
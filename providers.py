@@ -0,0 +1,161 @@
+#Provider registry shared by the PEARL apps
+#Chat model clients are built once per (provider, model, key, params) and reused
+#across reruns and sessions of the same server process. Provider SDKs are only
+#imported when a model of that provider is first used, so a process pays the
+#import cost of the providers its sessions select and nothing else. HTTP clients
+#send their requests through the shared keep-alive pools of http_pool.
+
+#external libraries
+import streamlit as st
+
+#Python libraries
+import importlib
+import logging
+import os
+import sys
+import threading
+import time
+
+from http_pool import get_http_client
+
+
+#Models offered in the model selector
+MODELS = {
+    "GPT 4o": {"provider": "openai", "model": "gpt-4o", "env_key": "OPENAI_API_KEY"},
+    "Sonnet 3.7": {"provider": "anthropic", "model": "claude-3-7-sonnet-20250219", "env_key": "ANTHROPIC_API_KEY"},
+    "Gemini Flash": {"provider": "google", "model": "gemini-2.0-flash", "env_key": "GOOGLE_API_KEY"},
+    "DeepSeek Chat": {"provider": "deepseek", "model": "deepseek-chat", "env_key": "DEEPSEEK_API_KEY"},
+}
+DEFAULT_MODEL = "GPT 4o"
+
+#Offline fake model for load tests (see fake_provider.py and load_test.py)
+FAKE_PROVIDER = os.getenv("PEARL_FAKE_PROVIDER", "0") == "1"
+if FAKE_PROVIDER:
+    MODELS["Fake (offline)"] = {"provider": "fake", "model": "fake", "env_key": None}
+
+#Context window and verbatim history budget (tokens) per provider model;
+#PEARL_HISTORY_TOKEN_BUDGET overrides the history budget for every model
+CONTEXT_LIMITS = {
+    "gpt-4o": {"context_window": 128000, "history_budget": 6000},
+    "gpt-4-turbo": {"context_window": 128000, "history_budget": 6000},
+    "claude-3-7-sonnet-20250219": {"context_window": 200000, "history_budget": 6000},
+    "gemini-2.0-flash": {"context_window": 1048576, "history_budget": 8000},
+    "deepseek-chat": {"context_window": 65536, "history_budget": 4000},
+}
+DEFAULT_HISTORY_BUDGET = 4000
+
+#Clients that are not requested again are evicted (least recently used first
+#once the cache is full, and unconditionally after the TTL)
+CLIENT_CACHE_MAX_ENTRIES = int(os.getenv("PEARL_CLIENT_CACHE_MAX_ENTRIES", "16"))
+CLIENT_CACHE_TTL = int(os.getenv("PEARL_CLIENT_CACHE_TTL", "3600"))
+
+#Seconds a single provider SDK import may take before the diagnostics flag it
+IMPORT_BUDGET = float(os.getenv("PEARL_IMPORT_BUDGET", "1.0"))
+
+#Import time of every provider module loaded by this process
+IMPORT_TIMES = {}
+_import_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+#functions
+def _import(module, provider):
+    """Import a provider SDK module on first use and record how long it took."""
+    with _import_lock:
+        if module not in sys.modules:
+            started = time.perf_counter()
+            importlib.import_module(module)
+            IMPORT_TIMES[module] = {"provider": provider, "seconds": time.perf_counter() - started}
+    return sys.modules[module]
+
+def _build_openai(model, api_key, params):
+    ChatOpenAI = _import("langchain_openai", "openai").ChatOpenAI
+    #stream_usage reports token usage (including cached tokens) on streamed replies
+    return ChatOpenAI(api_key=api_key, model_name=model, stream_usage=True, http_client=get_http_client("openai"), **params)
+
+def _build_anthropic(model, api_key, params):
+    try:
+        ChatAnthropic = _import("langchain_anthropic", "anthropic").ChatAnthropic
+    except ImportError:
+        ChatAnthropic = _import("langchain.chat_models", "anthropic").ChatAnthropic
+        return ChatAnthropic(model_name=model, anthropic_api_key=api_key, **params)
+    llm = ChatAnthropic(api_key=api_key, model_name=model, **params)
+    try:
+        #ChatAnthropic takes no http_client; seed its lazily built SDK client instead
+        anthropic = _import("anthropic", "anthropic")
+        llm.__dict__["_client"] = anthropic.Client(**llm._client_params, http_client=get_http_client("anthropic"))
+    except (ImportError, AttributeError, TypeError):
+        #Private attributes of langchain_anthropic may change: keep its own (unpooled) client
+        logger.warning("Could not attach the shared HTTP pool to ChatAnthropic", exc_info=True)
+    return llm
+
+def _build_google(model, api_key, params):
+    ChatGoogleGenerativeAI = _import("langchain_google_genai", "google").ChatGoogleGenerativeAI
+    try:
+        return ChatGoogleGenerativeAI(model=model, google_api_key=api_key, **params)
+    except Exception:
+        _import("google.generativeai", "google").configure(api_key=api_key)
+        return ChatGoogleGenerativeAI(model=model, safety_settings={"HARASSMENT": "block_none"}, **params)
+
+def _build_deepseek(model, api_key, params):
+    ChatDeepSeek = _import("langchain_deepseek", "deepseek").ChatDeepSeek
+    #ChatDeepSeek has no stream_usage field (it would be sent to the API as a parameter)
+    return ChatDeepSeek(api_key=api_key, model_name=model, http_client=get_http_client("deepseek"), **params)
+
+def _build_fake(model, api_key, params):
+    FakeChatModel = _import("fake_provider", "fake").FakeChatModel
+    return FakeChatModel(**{k: v for k, v in params.items() if k in FakeChatModel.model_fields})
+
+BUILDERS = {
+    "openai": _build_openai,
+    "anthropic": _build_anthropic,
+    "google": _build_google,
+    "deepseek": _build_deepseek,
+    "fake": _build_fake,
+}
+
+@st.cache_resource(max_entries=CLIENT_CACHE_MAX_ENTRIES, ttl=CLIENT_CACHE_TTL, show_spinner=False)
+def _cached_client(provider, model, api_key, params):
+    return BUILDERS[provider](model, api_key, dict(params))
+
+def get_client(provider, model, api_key=None, **params):
+    """Return the shared chat model client for a provider/model pair.
+
+    Keyword parameters (temperature, request_timeout, ...) are part of the cache
+    key, so clients with different settings never leak into each other.
+    """
+    if provider not in BUILDERS:
+        raise ValueError(f"Unknown provider: {provider}")
+    return _cached_client(provider, model, api_key, tuple(sorted(params.items())))
+
+def get_llm(llm_model, api_key=None, **params):
+    """Return the shared client for a label from the model selector."""
+    spec = MODELS[llm_model]
+    if api_key is None and spec["env_key"]:
+        api_key = os.getenv(spec["env_key"])
+    return get_client(spec["provider"], spec["model"], api_key, **params)
+
+def history_token_budget(model):
+    """Return the token budget for verbatim conversation history of a provider model."""
+    if os.getenv("PEARL_HISTORY_TOKEN_BUDGET"):
+        return int(os.getenv("PEARL_HISTORY_TOKEN_BUDGET"))
+    limits = CONTEXT_LIMITS.get(model, {})
+    budget = limits.get("history_budget", DEFAULT_HISTORY_BUDGET)
+    #Never let the history take more than half of the context window
+    return min(budget, limits.get("context_window", budget * 2) // 2)
+
+def clear_clients():
+    _cached_client.clear()
+
+def import_report(budget=IMPORT_BUDGET):
+    """Return the provider SDK modules loaded so far, slowest first, for the diagnostics view."""
+    return [
+        {
+            "module": module,
+            "provider": timing["provider"],
+            "import_s": round(timing["seconds"], 3),
+            "over_budget": timing["seconds"] > budget,
+        }
+        for module, timing in sorted(IMPORT_TIMES.items(), key=lambda item: -item[1]["seconds"])
+    ]
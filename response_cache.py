@@ -0,0 +1,113 @@
+#Deterministic response cache for repeated persona/question pairs
+#Replies are stored in a local SQLite file keyed by model, temperature,
+#persona, conversation so far and question, and shared by every session of the
+#server process. Entries expire after a TTL and the least recently used ones
+#are evicted once the cache is full. Off unless PEARL_RESPONSE_CACHE=1: a cached
+#reply is a repeat, not a fresh sample, which matters for persona research.
+
+#external libraries
+import streamlit as st
+from langchain_core.messages import get_buffer_string
+
+#Python libraries
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+
+RESPONSE_CACHE = os.getenv("PEARL_RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_PATH = os.getenv("PEARL_RESPONSE_CACHE_PATH", os.path.join(os.getenv("PEARL_DATA_DIR", ".pearl"), "responses.sqlite3"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("PEARL_RESPONSE_CACHE_MAX_ENTRIES", "5000"))
+RESPONSE_CACHE_TTL = int(os.getenv("PEARL_RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+
+
+#functions
+def normalize(text):
+    return re.sub(r"\s+", " ", text or "").strip().lower()
+
+def persona_hash(profile):
+    return hashlib.sha256(normalize(profile).encode("utf-8")).hexdigest()
+
+def cache_key(model, temperature, profile, history, question):
+    """Return the cache key for a question asked at a given point of an interview."""
+    if not isinstance(history, str):
+        history = get_buffer_string(history)
+    parts = [model, temperature, persona_hash(profile), normalize(history), normalize(question)]
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_entries=RESPONSE_CACHE_MAX_ENTRIES, ttl=RESPONSE_CACHE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL, last_used REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._db.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, model, response):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, model, response, now, now),
+            )
+            self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+        }
+
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    """Return the response cache shared by all sessions of this process."""
+    return ResponseCache()
@@ -0,0 +1,124 @@
+#Local retrieval over the turns of an interview
+#Every exchange is indexed as hashed TF-IDF features with NumPy, so finding the
+#earlier exchanges most relevant to a question needs no embedding service and
+#takes a few milliseconds for thousands of turns. Adding a turn only appends
+#its features; document frequencies and norms are derived when searching.
+
+#external libraries
+import numpy as np
+
+#Python libraries
+import math
+import re
+import zlib
+from functools import lru_cache
+
+
+#Hashed feature space (collisions are rare at interview vocabulary sizes)
+FEATURES = 2 ** 16
+#Entries (and vocabulary) an empty index has room for; arrays double as they fill
+INITIAL_ENTRIES = 256
+WORD = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+STOPWORDS = frozenset("""
+a about after again all also am an and any are as at be because been before being both but by can could did do does
+doing don't for from had has have having he her here hers him his how i i'm if in into is it it's its just me more most
+my no nor not now of off on once only or other our ours out over own really same she should so some such than that
+the their theirs them then there these they this those through to too under until up very was we were what when where
+which while who whom why will with would you your yours
+""".split())
+
+
+@lru_cache(maxsize=100_000)
+def _feature(word):
+    #crc32 is stable across processes, unlike hash()
+    return zlib.crc32(word.encode("utf-8")) % FEATURES
+
+def features(text):
+    """Return (feature ids, sublinear term frequencies) of a text."""
+    words = [word for word in WORD.findall(text.lower()) if word not in STOPWORDS]
+    if not words:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+    ids, counts = np.unique(np.fromiter((_feature(word) for word in words), dtype=np.int32, count=len(words)), return_counts=True)
+    return ids, (1 + np.log(counts)).astype(np.float32)
+
+
+class TurnIndex:
+    """Sparse hashed TF-IDF index of documents (interview exchanges), added one at a time.
+
+    Hashed features are given a column the first time they are seen, so the
+    document frequencies grow with the interview's vocabulary.
+    """
+
+    def __init__(self):
+        self.documents = 0
+        self._size = 0
+        self._columns = {}
+        self._ids = np.empty(INITIAL_ENTRIES, dtype=np.int32)
+        self._tf = np.empty(INITIAL_ENTRIES, dtype=np.float32)
+        self._rows = np.empty(INITIAL_ENTRIES, dtype=np.int32)
+        self._df = np.zeros(INITIAL_ENTRIES, dtype=np.int32)
+
+    def __len__(self):
+        return self.documents
+
+    def __getstate__(self):
+        #Pickle (e.g. when the session is spilled) without the unused capacity
+        state = dict(self.__dict__)
+        for name in ("_ids", "_tf", "_rows"):
+            state[name] = state[name][:self._size].copy()
+        state["_df"] = state["_df"][:len(self._columns)].copy()
+        return state
+
+    @staticmethod
+    def _grow(array, size):
+        if size <= len(array):
+            return array
+        grown = np.zeros(max(size, 2 * len(array)), dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def add(self, text):
+        """Index one more document; its row is the number of documents added before it."""
+        hashed, tf = features(text)
+        ids = np.fromiter((self._columns.setdefault(int(feature), len(self._columns)) for feature in hashed), dtype=np.int32, count=len(hashed))
+        end = self._size + len(ids)
+        self._ids, self._tf, self._rows = (self._grow(array, end) for array in (self._ids, self._tf, self._rows))
+        self._df = self._grow(self._df, len(self._columns))
+        self._ids[self._size:end] = ids
+        self._tf[self._size:end] = tf
+        self._rows[self._size:end] = self.documents
+        self._df[ids] += 1
+        self._size = end
+        self.documents += 1
+
+    def search(self, text, k, before=None):
+        """Return up to k (row, score) pairs most similar to text, best first.
+
+        Only rows below before are considered when it is given (e.g. to leave
+        out the recent turns that are in the prompt anyway).
+        """
+        before = self.documents if before is None else min(before, self.documents)
+        if k <= 0 or before <= 0:
+            return []
+        query_features, query_tf = features(text)
+        #Words the interview never used cannot match anything
+        known = [(self._columns[int(feature)], tf) for feature, tf in zip(query_features, query_tf) if int(feature) in self._columns]
+        if not known:
+            return []
+        columns = len(self._columns)
+        idf = np.log((1 + self.documents) / (1 + self._df[:columns])).astype(np.float32) + 1
+        query = np.zeros(columns, dtype=np.float32)
+        query_ids = np.array([column for column, _ in known], dtype=np.int32)
+        query[query_ids] = np.array([tf for _, tf in known], dtype=np.float32) * idf[query_ids]
+        size = np.searchsorted(self._rows[:self._size], before)
+        ids, rows = self._ids[:size], self._rows[:size]
+        weights = self._tf[:size] * idf[ids]
+        norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=before))
+        scores = np.bincount(rows, weights=weights * query[ids], minlength=before)
+        scores /= np.maximum(norms, 1e-9) * math.sqrt(float(query @ query))
+        k = min(k, int(np.count_nonzero(scores)))
+        if not k:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(row), float(scores[row])) for row in top]
@@ -0,0 +1,341 @@
+#Provider failover, retries and hedged requests
+#RoutedChatModel sits in front of the chat chains like any other chat model.
+#Each call goes to the selected provider first; failures are retried with
+#exponential backoff and then handed to the fallback providers in order,
+#providers whose circuit breaker is open are skipped, and a slow provider can
+#be hedged by starting the next one if no token has arrived by a deadline.
+#Every attempt waits for a slot of the process-wide scheduler before it is sent.
+#The provider that actually answered is reported in the reply's
+#response_metadata["answered_by"].
+
+#external libraries
+import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx
+
+#langchain libraries
+from langchain_core.language_models.chat_models import BaseChatModel, generate_from_stream
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+#Python libraries
+import contextvars
+import logging
+import os
+import queue
+import threading
+import time
+
+from prompting import adapt_messages
+from providers import MODELS, get_llm
+from scheduler import SchedulerCancelled, current_session, estimate_tokens, get_scheduler, queue_listener
+from tracing import span
+
+
+MAX_RETRIES = int(os.getenv("PEARL_MAX_RETRIES", "2"))
+RETRY_BACKOFF = float(os.getenv("PEARL_RETRY_BACKOFF", "1.0"))
+#Seconds without a first token before the next provider is started (0 = off)
+HEDGE_AFTER = float(os.getenv("PEARL_HEDGE_AFTER", "0"))
+#Comma separated model selector labels tried after the selected model
+FALLBACK_ORDER = [label.strip() for label in os.getenv("PEARL_FALLBACK_ORDER", "").split(",") if label.strip() in MODELS]
+
+BREAKER_FAILURES = int(os.getenv("PEARL_BREAKER_FAILURES", "3"))
+BREAKER_SLOW_SECONDS = float(os.getenv("PEARL_BREAKER_SLOW_SECONDS", "30"))
+BREAKER_COOLDOWN = float(os.getenv("PEARL_BREAKER_COOLDOWN", "60"))
+
+logger = logging.getLogger(__name__)
+
+
+class NoProviderAvailable(Exception):
+    """Raised when every provider of a call is held back by its circuit breaker."""
+
+
+class CircuitBreaker:
+    """Stops sending requests to a provider after repeated errors or slow replies.
+
+    After the cooldown one trial request is let through (half-open); its
+    outcome closes the breaker again or reopens it. A request takes the
+    breaker's permission with acquire() when it is actually sent, and gives
+    it back with release() if it ends without an outcome (e.g. cancelled).
+    """
+
+    def __init__(self, failures=BREAKER_FAILURES, slow_seconds=BREAKER_SLOW_SECONDS, cooldown=BREAKER_COOLDOWN):
+        self.failure_threshold = failures
+        self.slow_seconds = slow_seconds
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        #When the half-open trial in flight was sent (None: no trial in flight)
+        self.trial_started = None
+        self._lock = threading.Lock()
+
+    def _trial_free(self, now):
+        #A trial that never reported back is replaced after another cooldown
+        return self.trial_started is None or now - self.trial_started >= self.cooldown
+
+    def allow(self):
+        """Whether a request could be sent now; changes nothing."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "open":
+                return now - self.opened_at >= self.cooldown
+            return self.state == "closed" or self._trial_free(now)
+
+    def acquire(self, force=False):
+        """Take the permission to send one request.
+
+        Returns None when the request may not be sent, otherwise whether it
+        is the half-open trial. force lets a request through an open breaker.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "open" and now - self.opened_at >= self.cooldown:
+                self.state = "half-open"
+                self.trial_started = None
+            if self.state == "half-open" and self._trial_free(now):
+                self.trial_started = now
+                return True
+            if self.state == "closed" or force:
+                return False
+            return None
+
+    def release(self, trial):
+        """Give back the permission of a request that ended without an outcome."""
+        with self._lock:
+            if trial and self.state == "half-open":
+                self.trial_started = None
+
+    def record_success(self, latency):
+        if latency > self.slow_seconds:
+            #A latency spike counts as a strike
+            self.record_failure()
+            return
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self.trial_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_started = None
+            if self.state == "half-open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+@st.cache_resource(show_spinner=False)
+def get_circuit_breakers():
+    """Return the circuit breakers shared by all sessions, one per model label."""
+    return {label: CircuitBreaker() for label in MODELS}
+
+
+class RoutedChatModel(BaseChatModel):
+    """Chat model that routes each call over an ordered list of providers.
+
+    routes is a list of (label, provider, chat model) tuples, the first one
+    being the preferred provider.
+    """
+
+    routes: list
+    max_retries: int = MAX_RETRIES
+    retry_backoff: float = RETRY_BACKOFF
+    hedge_after: float = HEDGE_AFTER
+
+    @property
+    def _llm_type(self):
+        return "pearl-routed"
+
+    def _plan(self):
+        """Return the routes worth trying, and whether their breakers are to be overridden."""
+        breakers = get_circuit_breakers()
+        routes = [route for route in self.routes if breakers[route[0]].allow()]
+        #If every breaker is open, trying is still better than failing outright
+        return (routes, False) if routes else (list(self.routes), True)
+
+    def _backoff(self, retry):
+        return self.retry_backoff * 2 ** (retry - 1) if retry else 0.0
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.hedge_after > 0 and len(self.routes) > 1:
+            #Hedging needs the first-token deadline, so the reply is collected from the streamed path
+            result = generate_from_stream(self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
+            generation = result.generations[0]
+            generation.message.response_metadata.update(generation.generation_info or {})
+            return result
+        breakers = get_circuit_breakers()
+        scheduler = get_scheduler()
+        routes, forced = self._plan()
+        error = None
+        for label, provider, llm in routes:
+            adapted = adapt_messages(messages, provider)
+            for retry in range(self.max_retries + 1):
+                time.sleep(self._backoff(retry))
+                trial = breakers[label].acquire(force=forced)
+                if trial is None:
+                    #The breaker opened (or another request holds its trial): next provider
+                    break
+                try:
+                    with span("attempt", model=label, retry=retry), scheduler.slot(provider, estimate_tokens(adapted), on_wait=queue_listener.get()) as ticket:
+                        started = time.monotonic()
+                        message = llm.invoke(adapted, stop=stop, **kwargs)
+                    scheduler.settle(ticket, (message.usage_metadata or {}).get("total_tokens"))
+                except Exception as e:
+                    logger.warning("%s failed (attempt %d): %s", label, retry + 1, e)
+                    breakers[label].record_failure()
+                    error = e
+                    continue
+                except BaseException:
+                    #Interrupted (e.g. by a rerun) before the provider answered
+                    breakers[label].release(trial)
+                    raise
+                breakers[label].record_success(time.monotonic() - started)
+                logger.info("Reply answered by %s", label)
+                message.response_metadata["answered_by"] = label
+                #Time the call waited for a scheduler slot, for the turn's latency breakdown
+                message.response_metadata["queue_wait"] = ticket.wait
+                return ChatResult(generations=[ChatGeneration(message=message)])
+        raise error or NoProviderAvailable("Every provider's circuit breaker is open")
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        breakers = get_circuit_breakers()
+        scheduler = get_scheduler()
+        #Read on the caller's thread: the attempts run on worker threads
+        session = current_session()
+        listener = queue_listener.get()
+        plan, forced = self._plan()
+        events = queue.Queue()
+        attempts = {}
+        running = set()
+        state = {"next_route": 0}
+        first_launch = time.monotonic()
+
+        def worker(attempt, llm, provider, cancel, trial):
+            #The attempt settles its own breaker, so one cancelled or abandoned by the caller
+            #(e.g. a hedge loser) gives its half-open trial back instead of holding it
+            info = attempts[attempt]
+            breaker = breakers[info["label"]]
+            settled = False
+            try:
+                adapted = adapt_messages(messages, provider)
+                used_tokens = 0
+                with span("attempt", model=info["label"], retry=info["retry"]), \
+                        scheduler.slot(provider, estimate_tokens(adapted), session=session, on_wait=listener, cancel=cancel) as ticket:
+                    info["started"] = time.monotonic()
+                    info["queue_wait"] = ticket.wait
+                    for chunk in llm.stream(adapted, stop=stop, **kwargs):
+                        if cancel.is_set():
+                            return
+                        if not settled:
+                            settled = True
+                            breaker.record_success(time.monotonic() - info["started"])
+                        used_tokens += (chunk.usage_metadata or {}).get("total_tokens", 0)
+                        events.put(("chunk", attempt, chunk))
+                scheduler.settle(ticket, used_tokens)
+                if not settled:
+                    settled = True
+                    breaker.record_success(time.monotonic() - info["started"])
+                events.put(("done", attempt, None))
+            except SchedulerCancelled:
+                return
+            except Exception as e:
+                if cancel.is_set():
+                    return
+                settled = True
+                breaker.record_failure()
+                events.put(("error", attempt, e))
+            finally:
+                if not settled:
+                    breaker.release(trial)
+
+        def launch(index, retry=0):
+            time.sleep(self._backoff(retry))
+            label, provider, llm = plan[index]
+            trial = breakers[label].acquire(force=forced)
+            if trial is None:
+                #The breaker opened (or another request holds its trial) meanwhile
+                return False
+            attempt = len(attempts)
+            cancel = threading.Event()
+            attempts[attempt] = {"index": index, "retry": retry, "label": label, "cancel": cancel, "started": time.monotonic()}
+            running.add(attempt)
+            #Attempts run in a copy of the caller's context, so context-configured callbacks (usage metering) see them
+            thread = threading.Thread(target=contextvars.copy_context().run, args=(worker, attempt, llm, provider, cancel, trial), daemon=True)
+            #The queue position callback may update the page from the worker thread
+            add_script_run_ctx(thread)
+            thread.start()
+            return True
+
+        def launch_next_route():
+            while state["next_route"] < len(plan):
+                state["next_route"] += 1
+                if launch(state["next_route"] - 1):
+                    return True
+            return False
+
+        if not launch_next_route():
+            raise NoProviderAvailable("Every provider's circuit breaker is open")
+        try:
+            winner = None
+            hedged = False
+            while True:
+                timeout = None
+                if winner is None and not hedged and self.hedge_after > 0 and state["next_route"] < len(plan):
+                    timeout = max(0.0, first_launch + self.hedge_after - time.monotonic())
+                try:
+                    kind, attempt, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    #No token yet: hedge with the next provider, first to answer wins
+                    hedged = True
+                    logger.info("No token from %s after %.1f s, hedging", plan[0][0], self.hedge_after)
+                    launch_next_route()
+                    continue
+                info = attempts[attempt]
+                if winner is not None and attempt != winner:
+                    continue
+                if kind == "error":
+                    running.discard(attempt)
+                    logger.warning("%s failed (attempt %d): %s", info["label"], info["retry"] + 1, payload)
+                    if winner is not None:
+                        #Part of the reply was already streamed, it cannot be replaced
+                        raise payload
+                    retried = info["retry"] < self.max_retries and launch(info["index"], info["retry"] + 1)
+                    if not retried and not running and not launch_next_route():
+                        raise payload
+                    continue
+                if winner is None:
+                    winner = attempt
+                    for other in attempts:
+                        if other != attempt:
+                            attempts[other]["cancel"].set()
+                    logger.info("Reply answered by %s", info["label"])
+                    generation_info = {"answered_by": info["label"], "queue_wait": info.get("queue_wait")}
+                    if kind == "chunk":
+                        yield ChatGenerationChunk(message=payload, generation_info=generation_info)
+                    else:
+                        yield ChatGenerationChunk(message=AIMessageChunk(content=""), generation_info=generation_info)
+                        return
+                    continue
+                if kind == "done":
+                    return
+                yield ChatGenerationChunk(message=payload)
+        finally:
+            #Stop the losing (or abandoned) attempts from reading their streams
+            for info in attempts.values():
+                info["cancel"].set()
+
+
+#functions
+def routed_llm(llm_model, fallbacks=(), **params):
+    """Return a RoutedChatModel for the selected model and its fallbacks."""
+    labels = [llm_model] + [label for label in fallbacks if label != llm_model and label in MODELS]
+    routes = []
+    for label in labels:
+        #Skip fallbacks without a configured API key
+        env_key = MODELS[label]["env_key"]
+        if label != llm_model and env_key and not os.getenv(env_key):
+            continue
+        #The SDK's own retries are turned off: the router's retries and backoff are the only layer,
+        #so a failing provider holds a scheduler slot for one request at a time and its breaker sees every failure
+        routes.append((label, MODELS[label]["provider"], get_llm(label, max_retries=0)))
+    return RoutedChatModel(routes=routes, **params)
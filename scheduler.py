@@ -0,0 +1,281 @@
+#Process-wide scheduler for provider calls
+#Every model call asks the scheduler for a slot before it is sent. A slot is
+#granted when fewer than PEARL_MAX_CONCURRENT_CALLS calls are in flight and the
+#provider's requests-per-minute and tokens-per-minute buckets allow it. Waiting
+#calls are served round-robin across sessions, so a burst from one classroom
+#queues up instead of turning into 429s, and no session can starve the others.
+#Background calls (e.g. speculative answers) wait in a queue of their own and
+#are only granted a slot while no foreground call is waiting.
+
+#external libraries
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+#langchain libraries
+from langchain_core.messages import get_buffer_string
+
+#Python libraries
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from tokens import count_tokens
+
+
+MAX_CONCURRENT_CALLS = int(os.getenv("PEARL_MAX_CONCURRENT_CALLS", "8"))
+#Output tokens reserved per call until the provider reports the real usage
+RESERVED_OUTPUT_TOKENS = int(os.getenv("PEARL_RESERVED_OUTPUT_TOKENS", "500"))
+#How often a waiting call re-checks its place in the queue (seconds)
+QUEUE_POLL_INTERVAL = 0.5
+#Sessions remembered for round-robin ordering
+SERVED_HISTORY = 1000
+
+
+def _limits(name, defaults):
+    #"openai=500,anthropic=50" overrides the defaults of the listed providers
+    limits = dict(defaults)
+    for item in os.getenv(name, "").split(","):
+        provider, _, value = item.partition("=")
+        if value.strip():
+            limits[provider.strip()] = float(value)
+    return limits
+
+PROVIDER_RPM = _limits("PEARL_PROVIDER_RPM", {"openai": 500, "anthropic": 50, "google": 1000, "deepseek": 1000})
+PROVIDER_TPM = _limits("PEARL_PROVIDER_TPM", {"openai": 30000, "anthropic": 20000, "google": 1000000, "deepseek": 1000000})
+
+#Callback receiving the queue position of the calls made by the current turn
+queue_listener = contextvars.ContextVar("queue_listener", default=None)
+#Whether the calls made in the current context yield to foreground calls
+background_calls = contextvars.ContextVar("background_calls", default=False)
+
+
+class SchedulerCancelled(Exception):
+    """Raised in a call that was abandoned while it waited for a slot."""
+
+
+class TokenBucket:
+    """Refills continuously up to a per-minute capacity."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until amount can be taken (0 if it can be taken now)."""
+        self._refill()
+        #A request bigger than the whole bucket only has to wait for a full one
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class Ticket:
+    def __init__(self, session, provider, tokens, background=False):
+        self.session = session
+        self.provider = provider
+        self.tokens = tokens
+        self.background = background
+        self.granted = False
+        self.enqueued = time.monotonic()
+        self.wait = None
+
+
+class Scheduler:
+    def __init__(self, max_concurrent=MAX_CONCURRENT_CALLS, rpm=PROVIDER_RPM, tpm=PROVIDER_TPM):
+        self.max_concurrent = max_concurrent
+        self.rpm = rpm
+        self.tpm = tpm
+        self.running = 0
+        self._buckets = {}
+        #session -> waiting tickets (foreground and background), and when each session was last served
+        self._queues = {}
+        self._background = {}
+        self._served = {}
+        self._grants = 0
+        self._cond = threading.Condition()
+
+    def _provider_buckets(self, provider):
+        if provider not in self._buckets:
+            self._buckets[provider] = (
+                #Providers without a configured limit are effectively unlimited
+                TokenBucket(self.rpm.get(provider, 1e9)),
+                TokenBucket(self.tpm.get(provider, 1e12)),
+            )
+        return self._buckets[provider]
+
+    def _rotation(self, queues):
+        #Sessions that were served longest ago (or never) go first
+        return sorted(queues, key=lambda session: self._served.get(session, -1))
+
+    def _queues_of(self, ticket):
+        return self._background if ticket.background else self._queues
+
+    def _grant(self):
+        """Grant slots to waiting tickets, round-robin; return seconds until a rate limit frees up."""
+        retry_in = None
+        granted, any_granted = True, False
+        while granted and self.running < self.max_concurrent:
+            granted = False
+            #Background tickets are only considered while no foreground ticket waits
+            queues = self._queues or self._background
+            for session in self._rotation(queues):
+                tickets = queues[session]
+                ticket = tickets[0]
+                requests, tokens = self._provider_buckets(ticket.provider)
+                wait = max(requests.wait_time(1), tokens.wait_time(ticket.tokens))
+                if wait > 0:
+                    retry_in = wait if retry_in is None else min(retry_in, wait)
+                    continue
+                requests.take(1)
+                tokens.take(ticket.tokens)
+                ticket.granted = True
+                ticket.wait = time.monotonic() - ticket.enqueued
+                self.running += 1
+                self._grants += 1
+                self._served[session] = self._grants
+                tickets.popleft()
+                if not tickets:
+                    del queues[session]
+                granted = any_granted = True
+                break
+        if any_granted:
+            self._cond.notify_all()
+        if len(self._served) > SERVED_HISTORY:
+            #Forget sessions that are not waiting; they rejoin as never served
+            self._served = {session: self._served[session] for session in [*self._queues, *self._background] if session in self._served}
+        return retry_in
+
+    def _position(self, ticket):
+        #Round-robin order: the k-th call of a session goes after the k-th call of every other session
+        queues = self._queues_of(ticket)
+        sessions = self._rotation(queues)
+        mine = sessions.index(ticket.session)
+        rank = queues[ticket.session].index(ticket)
+        ahead = rank
+        for i, session in enumerate(sessions):
+            if session != ticket.session:
+                ahead += min(len(queues[session]), rank + 1 if i < mine else rank)
+        if ticket.background:
+            #Every waiting foreground call goes first
+            ahead += sum(len(tickets) for tickets in self._queues.values())
+        return ahead + 1
+
+    def _withdraw(self, ticket):
+        queues = self._queues_of(ticket)
+        tickets = queues[ticket.session]
+        tickets.remove(ticket)
+        if not tickets:
+            del queues[ticket.session]
+
+    @contextmanager
+    def slot(self, provider, tokens, session=None, on_wait=None, cancel=None, background=None):
+        """Hold one of the scheduler's slots for a call to provider.
+
+        on_wait(position) is called while the call waits in the queue; setting
+        the cancel event gives up the place in the queue. A background call
+        (by default, one made inside in_background()) waits until no
+        foreground call is queued.
+        """
+        background = background_calls.get() if background is None else background
+        ticket = Ticket(session or current_session(), provider, tokens, background)
+        with self._cond:
+            self._queues_of(ticket).setdefault(ticket.session, deque()).append(ticket)
+        reported = None
+        try:
+            while True:
+                with self._cond:
+                    retry_in = self._grant()
+                    if ticket.granted:
+                        break
+                    if cancel is not None and cancel.is_set():
+                        raise SchedulerCancelled()
+                    position = self._position(ticket)
+                if on_wait is not None and position != reported:
+                    on_wait(position)
+                    reported = position
+                with self._cond:
+                    if not ticket.granted:
+                        self._cond.wait(min(retry_in or QUEUE_POLL_INTERVAL, QUEUE_POLL_INTERVAL))
+        except BaseException:
+            #Leave the queue (or give back a slot granted meanwhile) when the wait is
+            #interrupted, e.g. by a cancel or a Streamlit rerun raised from on_wait
+            with self._cond:
+                if ticket.granted:
+                    self.running -= 1
+                    self._grant()
+                    self._cond.notify_all()
+                else:
+                    self._withdraw(ticket)
+            raise
+        try:
+            yield ticket
+        finally:
+            with self._cond:
+                self.running -= 1
+                self._grant()
+                self._cond.notify_all()
+
+    def settle(self, ticket, used_tokens):
+        """Return the tokens a finished call reserved but did not use."""
+        if used_tokens and used_tokens < ticket.tokens:
+            with self._cond:
+                self._provider_buckets(ticket.provider)[1].give_back(ticket.tokens - used_tokens)
+                self._grant()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "running": self.running,
+                "waiting": sum(len(tickets) for queues in (self._queues, self._background) for tickets in queues.values()),
+                "sessions_waiting": len(self._queues.keys() | self._background.keys()),
+            }
+
+
+#functions
+def current_session():
+    """Return the fairness key of the calling thread: its Streamlit session, if any."""
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx is not None else threading.current_thread().name
+
+def estimate_tokens(messages):
+    """Return the tokens to reserve for a call: the prompt plus RESERVED_OUTPUT_TOKENS."""
+    return count_tokens(get_buffer_string(messages)) + RESERVED_OUTPUT_TOKENS
+
+@contextmanager
+def reporting_queue(callback):
+    """Send the queue position of the calls made inside the block to callback."""
+    token = queue_listener.set(callback)
+    try:
+        yield
+    finally:
+        queue_listener.reset(token)
+
+@contextmanager
+def in_background():
+    """Make the calls inside the block yield to foreground calls in the scheduler."""
+    token = background_calls.set(True)
+    try:
+        yield
+    finally:
+        background_calls.reset(token)
+
+@st.cache_resource(show_spinner=False)
+def get_scheduler():
+    """Return the scheduler shared by all sessions of this process."""
+    return Scheduler()
@@ -0,0 +1,221 @@
+#Idle-session spill
+#Streamlit keeps the st.session_state of every session in memory for as long as
+#the session exists, so the interview histories of idle tabs pile up in the
+#server process. A background sweeper compresses the history keys of sessions
+#that have not rerun for PEARL_SESSION_IDLE seconds (and of the least recently
+#used ones while the resident histories exceed PEARL_SESSION_MEMORY_MB) with
+#zstandard and writes them to local disk. A session's next rerun reads them back
+#before the script touches its state.
+
+#external libraries
+import streamlit as st
+import zstandard
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+#Python libraries
+import atexit
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+
+
+SESSION_SPILL = os.getenv("PEARL_SESSION_SPILL", "1") != "0"
+SESSION_IDLE = float(os.getenv("PEARL_SESSION_IDLE", "900"))
+SESSION_MEMORY_MB = float(os.getenv("PEARL_SESSION_MEMORY_MB", "256"))
+SPILL_DIR = os.getenv("PEARL_SPILL_DIR", os.path.join(os.getenv("PEARL_DATA_DIR", ".pearl"), "spill"))
+SPILL_LEVEL = int(os.getenv("PEARL_SPILL_LEVEL", "3"))
+#Sessions that reran this recently are never spilled, even over the memory cap (seconds)
+MIN_IDLE = 300
+#How often the sweeper measures and spills sessions (seconds)
+SWEEP_INTERVAL = 30
+
+logger = logging.getLogger(__name__)
+
+
+def _memories(value):
+    #Langchain memories inside a session value: a memory, a CombinedMemory or a dict of them
+    if isinstance(value, dict):
+        for item in value.values():
+            yield from _memories(item)
+    elif hasattr(value, "memories"):
+        for memory in value.memories:
+            yield from _memories(memory)
+    elif hasattr(value, "chat_memory"):
+        yield value
+
+
+class _Session:
+    def __init__(self, state):
+        self.state = weakref.ref(state)
+        self.keys = ()
+        self.drop = ()
+        self.last_seen = time.monotonic()
+        #Serialized size of the history keys and the last_seen it was measured at
+        self.size = 0
+        self.measured = None
+        #Spill file while the history is on disk
+        self.path = None
+        self.lock = threading.Lock()
+
+
+class SessionSpill:
+    """Moves the histories of idle sessions to compressed files and back."""
+
+    def __init__(self, directory=SPILL_DIR, idle=SESSION_IDLE, memory_mb=SESSION_MEMORY_MB):
+        os.makedirs(directory, exist_ok=True)
+        #Sessions do not outlive the process, so neither does its spill directory
+        self.directory = tempfile.mkdtemp(prefix=f"{os.getpid()}-", dir=directory)
+        self.idle = idle
+        self.memory_cap = memory_mb * 1024 * 1024
+        self.spills = 0
+        self.rehydrations = 0
+        self._sessions = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, name="session-spill", daemon=True).start()
+
+    def touch(self, keys, drop=()):
+        """Record a rerun of the current session, reading its history back first if it was spilled.
+
+        keys are the session state keys holding the history; drop are keys
+        (chains, clients) that the script rebuilds from them instead of spilling.
+        """
+        ctx = get_script_run_ctx()
+        if ctx is None:
+            return
+        state = ctx.session_state._state
+        with self._lock:
+            session = self._sessions.get(ctx.session_id)
+            if session is None or session.state() is not state:
+                session = self._sessions[ctx.session_id] = _Session(state)
+        with session.lock:
+            session.keys, session.drop = tuple(keys), tuple(drop)
+            session.last_seen = time.monotonic()
+            if session.path is not None:
+                self._rehydrate(session, state)
+
+    def _serialize(self, session, state):
+        """Return the pickled history of a session and the keys it covers.
+
+        Values that cannot be pickled (memories holding a model client) stay in
+        memory; only the chat histories inside them are included.
+        """
+        values, histories = {}, {}
+        for key in session.keys:
+            if key not in state:
+                continue
+            value = state[key]
+            try:
+                values[key] = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            except (TypeError, AttributeError, pickle.PicklingError):
+                histories[key] = [list(memory.chat_memory.messages) for memory in _memories(value)]
+        payload = pickle.dumps({"values": values, "histories": histories}, pickle.HIGHEST_PROTOCOL)
+        return payload, list(values), list(histories)
+
+    def _spill(self, session, state, serialized):
+        payload, value_keys, history_keys = serialized
+        path = os.path.join(self.directory, f"{id(session):x}.zst")
+        with open(path, "wb") as f:
+            f.write(zstandard.ZstdCompressor(level=SPILL_LEVEL).compress(payload))
+        for key in value_keys:
+            del state[key]
+        for key in history_keys:
+            for memory in _memories(state[key]):
+                memory.chat_memory.clear()
+        for key in session.drop:
+            if key in state:
+                del state[key]
+        session.path = path
+        session.size = 0
+        self.spills += 1
+
+    def _rehydrate(self, session, state):
+        with open(session.path, "rb") as f:
+            data = pickle.loads(zstandard.ZstdDecompressor().decompress(f.read()))
+        for key, value in data["values"].items():
+            state[key] = pickle.loads(value)
+        for key, histories in data["histories"].items():
+            if key in state:
+                for memory, messages in zip(_memories(state[key]), histories):
+                    memory.chat_memory.add_messages(messages)
+        os.remove(session.path)
+        session.path = None
+        session.measured = None
+        self.rehydrations += 1
+
+    def sweep(self):
+        """Spill idle sessions, then the least recently used ones while over the memory cap."""
+        with self._lock:
+            for session_id, session in list(self._sessions.items()):
+                #Sessions Streamlit has closed: their state is gone, so is their spill
+                if session.state() is None:
+                    del self._sessions[session_id]
+                    if session.path is not None:
+                        os.remove(session.path)
+            sessions = sorted(self._sessions.values(), key=lambda session: session.last_seen)
+        resident = []
+        for session in sessions:
+            with session.lock:
+                state = session.state()
+                if session.path is not None or state is None:
+                    continue
+                idle = time.monotonic() - session.last_seen
+                if idle < self.idle and session.measured == session.last_seen:
+                    resident.append(session)
+                    continue
+                try:
+                    serialized = self._serialize(session, state)
+                except RuntimeError:
+                    #Changed by a rerun while it was being read; measured next sweep
+                    continue
+                if idle >= self.idle:
+                    self._spill(session, state, serialized)
+                else:
+                    session.size, session.measured = len(serialized[0]), session.last_seen
+                    resident.append(session)
+        over = sum(session.size for session in resident) - self.memory_cap
+        for session in resident:
+            if over <= 0:
+                break
+            with session.lock:
+                state = session.state()
+                if state is None or session.path is not None or time.monotonic() - session.last_seen < MIN_IDLE:
+                    continue
+                over -= session.size
+                self._spill(session, state, self._serialize(session, state))
+
+    def _run(self):
+        while True:
+            time.sleep(SWEEP_INTERVAL)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Session spill sweep failed")
+
+    def report(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        spilled = [session.path for session in sessions if session.path is not None]
+        return {
+            "sessions": len(sessions),
+            "spilled": len(spilled),
+            "resident_mb": round(sum(session.size for session in sessions) / (1024 * 1024), 2),
+            "spilled_mb": round(sum(os.path.getsize(path) for path in spilled if os.path.exists(path)) / (1024 * 1024), 2),
+            "spills": self.spills,
+            "rehydrations": self.rehydrations,
+        }
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+@st.cache_resource(show_spinner=False)
+def get_session_spill():
+    """Return the session spill shared by all sessions of this process."""
+    spill = SessionSpill()
+    atexit.register(spill.close)
+    return spill
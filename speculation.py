@@ -0,0 +1,262 @@
+#Speculative answers to suggested follow-up questions
+#After a reply, the model suggests a few questions the researcher is likely to
+#ask next, and the persona's answers to them are computed in the background
+#while the researcher reads. Clicking a suggestion shows its answer at once and
+#only appends the exchange to the memory. Speculative calls are metered with
+#the purpose "speculation", stay within a per-session token budget, and the
+#answers nobody asked for are counted (tokens and cost) as discarded.
+
+#external libraries
+import streamlit as st
+
+#langchain libraries
+from langchain_core.chat_history import InMemoryChatMessageHistory
+from langchain_core.messages import HumanMessage, get_buffer_string
+
+#Python libraries
+import contextvars
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from metering import call_cost, metered_as
+from providers import MODELS
+from scheduler import estimate_tokens, in_background
+from streaming import chunk_text
+from tracing import span
+
+
+SPECULATION = os.getenv("PEARL_SPECULATION", "0") == "1"
+SPECULATIVE_QUESTIONS = int(os.getenv("PEARL_SPECULATIVE_QUESTIONS", "3"))
+#Tokens (prompt and reply) a session may spend on speculative calls
+SPECULATION_TOKEN_BUDGET = int(os.getenv("PEARL_SPECULATION_TOKEN_BUDGET", "50000"))
+#Messages of the interview the suggestions are based on
+SUGGESTION_CONTEXT = 6
+#How often the page checks whether the suggestions are ready (seconds)
+SUGGESTION_POLL = 1.0
+#Seconds a clicked suggestion waits for its unfinished answer before the question is asked normally
+SPECULATION_TAKE_TIMEOUT = float(os.getenv("PEARL_SPECULATION_TAKE_TIMEOUT", "2"))
+
+SUGGESTION_PROMPT = """This is the latest part of a research interview with a persona:
+
+{transcript}
+
+Suggest {count} short follow-up questions the researcher is likely to ask next. Write one question per line, without numbering or any other text."""
+
+#Speculative calls run on their own pool as background calls: the scheduler only
+#grants them a slot while no real turn is waiting for one
+SPECULATION_WORKERS = int(os.getenv("PEARL_SPECULATION_WORKERS", "8"))
+_speculation_executor = ThreadPoolExecutor(max_workers=SPECULATION_WORKERS, thread_name_prefix="pearl-speculation")
+
+logger = logging.getLogger(__name__)
+
+
+def _snapshot_memory(memory, messages):
+    #A private copy of the memory over the history so far: the script thread keeps using the original
+    fields = {name: getattr(memory, name) for name in type(memory).model_fields if name != "chat_memory"}
+    return type(memory)(**fields, chat_memory=InMemoryChatMessageHistory(messages=messages))
+
+def _questions(text, count):
+    questions = []
+    for line in text.splitlines():
+        line = re.sub(r"^\s*(?:[-*•]|\d+[.)])?\s*", "", line).strip().strip('"')
+        if line and line not in questions:
+            questions.append(line)
+    return questions[:count]
+
+
+class Speculation:
+    """Suggested questions and their answers for one point of an interview."""
+
+    def __init__(self, history_size):
+        #Messages in the memory when it started; the answers are only valid as the very next turn
+        self.history_size = history_size
+        self.questions = None
+        self.answers = {}
+        self.finished = False
+        self.discarded = False
+
+
+class Speculator:
+    """Speculative follow-up answers of one session, within its token budget."""
+
+    def __init__(self, budget=SPECULATION_TOKEN_BUDGET, count=SPECULATIVE_QUESTIONS):
+        self.budget = budget
+        self.count = count
+        self.spent = 0
+        self.current = None
+        self.used = {"answers": 0, "tokens": 0, "cost_usd": 0.0}
+        self.discarded = {"answers": 0, "tokens": 0, "cost_usd": 0.0}
+        self._reserved = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens):
+        with self._lock:
+            if self.spent + self._reserved + tokens > self.budget:
+                return False
+            self._reserved += tokens
+            return True
+
+    def _settle(self, reserved, used):
+        with self._lock:
+            self._reserved -= reserved
+            self.spent += used
+
+    def _count(self, totals, result):
+        with self._lock:
+            totals["answers"] += 1
+            totals["tokens"] += result["tokens"]
+            totals["cost_usd"] += result["cost_usd"]
+
+    def _invoke(self, llm, messages, estimate=None):
+        #Returns None when the budget has no room for the call (unless estimate was reserved already)
+        if estimate is None:
+            estimate = estimate_tokens(messages)
+            if not self._reserve(estimate):
+                return None
+        used = estimate
+        try:
+            message = llm.invoke(messages)
+            used = (message.usage_metadata or {}).get("total_tokens") or estimate
+            return message
+        finally:
+            self._settle(estimate, used)
+
+    def start(self, chain):
+        """Discard the previous speculation and start one for the chain's current history."""
+        self.discard()
+        messages = list(chain.memory.chat_memory.messages)
+        speculation = self.current = Speculation(len(messages))
+        if self.spent < self.budget:
+            #The context carries the session's meter and trace into the workers
+            _speculation_executor.submit(contextvars.copy_context().run, self._speculate, speculation, chain, messages)
+        else:
+            speculation.questions = []
+            speculation.finished = True
+
+    def _speculate(self, speculation, chain, messages):
+        try:
+            with metered_as("speculation"), in_background(), span("speculation"):
+                prompt = SUGGESTION_PROMPT.format(transcript=get_buffer_string(messages[-SUGGESTION_CONTEXT:]), count=self.count)
+                message = self._invoke(chain.llm, [HumanMessage(content=prompt)])
+                questions = _questions(chunk_text(message), self.count) if message is not None else []
+                memory = _snapshot_memory(chain.memory, messages)
+                for question in questions:
+                    if speculation.discarded:
+                        break
+                    variables = memory.load_memory_variables({memory.input_key or "input": question})
+                    inputs = {**variables, "input": question}
+                    prompt = chain.prompt.format_prompt(**{key: inputs[key] for key in chain.prompt.input_variables}).to_messages()
+                    #Only questions whose answer fits in the budget are suggested
+                    estimate = estimate_tokens(prompt)
+                    if not self._reserve(estimate):
+                        break
+                    future = _speculation_executor.submit(contextvars.copy_context().run, self._answer, chain, prompt, estimate)
+                    speculation.answers[question] = (future, estimate)
+                speculation.questions = list(speculation.answers)
+        except Exception:
+            logger.exception("Preparing follow-up suggestions failed")
+            speculation.questions = list(speculation.answers)
+        finally:
+            with self._lock:
+                speculation.finished = True
+                answers = speculation.answers if speculation.discarded else None
+            if answers:
+                self._discard(answers)
+
+    def _answer(self, chain, messages, estimate):
+        with span("speculative answer"):
+            message = self._invoke(chain.llm, messages, estimate)
+        usage = message.usage_metadata or {}
+        answered_by = message.response_metadata.get("answered_by")
+        model = MODELS.get(answered_by, {}).get("model")
+        cost = call_cost(
+            model,
+            usage.get("input_tokens") or 0,
+            (usage.get("input_token_details") or {}).get("cache_read") or 0,
+            usage.get("output_tokens") or 0,
+        )
+        return {
+            "answer": chunk_text(message),
+            "answered_by": answered_by,
+            "tokens": usage.get("total_tokens") or 0,
+            "cost_usd": cost or 0.0,
+        }
+
+    def suggestions(self):
+        """Return the suggested questions, or None while they are being prepared."""
+        speculation = self.current
+        if speculation is None or speculation.discarded:
+            return []
+        return speculation.questions
+
+    def take(self, question, history_size, timeout=SPECULATION_TAKE_TIMEOUT):
+        """Return the prepared answer to question, or None.
+
+        An answer that is not ready within timeout seconds is given up (and
+        counted as discarded), so the question is asked normally instead.
+        """
+        speculation = self.current
+        if speculation is None or speculation.discarded or speculation.history_size != history_size:
+            return None
+        answer = speculation.answers.pop(question, None)
+        if answer is None:
+            return None
+        try:
+            result = answer[0].result(timeout)
+        except FutureTimeout:
+            self._discard({question: answer})
+            return None
+        except Exception:
+            return None
+        if result is not None:
+            self._count(self.used, result)
+        return result
+
+    def discard(self):
+        """Give up the current speculation; answers not taken are counted as discarded."""
+        with self._lock:
+            speculation, self.current = self.current, None
+            if speculation is None or speculation.discarded:
+                return
+            speculation.discarded = True
+            #A speculation still suggesting questions discards its answers when it finishes
+            answers = speculation.answers if speculation.finished else None
+        if answers:
+            self._discard(answers)
+
+    def _discard(self, answers):
+        for future, estimate in list(answers.values()):
+            if future.cancel():
+                #Never started: give its reservation back to the budget
+                self._settle(estimate, 0)
+            else:
+                #Answers still being generated are counted once they are done
+                future.add_done_callback(self._discarded)
+
+    def _discarded(self, future):
+        try:
+            result = future.result()
+        except Exception:
+            return
+        if result is not None:
+            self._count(self.discarded, result)
+
+    def report(self):
+        with self._lock:
+            return {
+                "budget": self.budget,
+                "spent": self.spent,
+                "used": dict(self.used),
+                "discarded": dict(self.discarded),
+            }
+
+
+#functions
+def session_speculator():
+    """Return the speculator of the current session."""
+    if "speculator" not in st.session_state:
+        st.session_state.speculator = Speculator()
+    return st.session_state.speculator
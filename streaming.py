@@ -0,0 +1,154 @@
+#Token streaming for the PEARL chat chains
+#Replies are yielded chunk by chunk so Streamlit can draw them as they arrive
+#(st.write_stream), and the full reply is committed to the chain memory once
+#the stream is finished, exactly like chain.run would have done.
+
+#external libraries
+from streamlit.runtime.scriptrunner import add_script_run_ctx
+
+#Python libraries
+import contextvars
+import os
+import queue
+import threading
+from contextlib import nullcontext
+
+from scheduler import estimate_tokens, get_scheduler, queue_listener
+from tracing import span
+
+
+#Streaming can be turned off server-wide with PEARL_STREAMING=0
+STREAMING = os.getenv("PEARL_STREAMING", "1") != "0"
+
+
+#functions
+def chunk_text(chunk):
+    """Return the text carried by a streamed message chunk."""
+    content = getattr(chunk, "content", chunk)
+    if isinstance(content, str):
+        return content
+    #Some providers stream a list of content blocks instead of plain text
+    parts = []
+    for block in content:
+        if isinstance(block, str):
+            parts.append(block)
+        elif isinstance(block, dict) and block.get("type") == "text":
+            parts.append(block.get("text", ""))
+    return "".join(parts)
+
+def merge_usage(total, usage):
+    """Add the usage metadata of one message (chunk) to a running total."""
+    if not usage:
+        return total
+    for key in ("input_tokens", "output_tokens", "total_tokens"):
+        total[key] = total.get(key, 0) + (usage.get(key) or 0)
+    details = total.setdefault("input_token_details", {})
+    for key, value in (usage.get("input_token_details") or {}).items():
+        #Some providers repeat the cumulative cache counts on every chunk
+        details[key] = max(details.get(key) or 0, value or 0)
+    return total
+
+def _prepare(chain, inputs):
+    with span("memory.load"):
+        inputs = chain.prep_inputs(inputs)
+    prompt_inputs = {k: v for k, v in inputs.items() if k in chain.prompt.input_variables}
+    return inputs, chain.prompt.format_prompt(**prompt_inputs)
+
+def _slot(provider, prompt_value):
+    #Chains with a RoutedChatModel schedule each provider attempt themselves
+    if provider is None:
+        return nullcontext()
+    return get_scheduler().slot(provider, estimate_tokens(prompt_value.to_messages()), on_wait=queue_listener.get())
+
+def _settle(ticket, usage):
+    if ticket is not None:
+        get_scheduler().settle(ticket, usage.get("total_tokens"))
+        usage["queue_wait"] = ticket.wait
+
+def _routing_metadata(usage, metadata):
+    #Which provider answered, and how long it waited for a slot, when a RoutedChatModel made the call
+    for key in ("answered_by", "queue_wait"):
+        if metadata.get(key) is not None:
+            usage[key] = metadata[key]
+
+def stream_chain(chain, inputs, usage=None, provider=None):
+    """Yield the reply of a ConversationChain/LLMChain as it is generated.
+
+    The chain's memory is loaded before the call and updated with the complete
+    reply after the last chunk, so the history matches a blocking chain.run.
+    Provider usage metadata (input, output and cached tokens) is accumulated
+    into the usage dict when one is given, along with the provider that
+    answered when the chain uses a RoutedChatModel and the time the call
+    waited for a slot of the process-wide scheduler (queue_wait, seconds).
+    With a provider the chain's own call is scheduled here.
+    """
+    inputs, prompt_value = _prepare(chain, inputs)
+    usage = {} if usage is None else usage
+    chunks = []
+    with _slot(provider, prompt_value) as ticket:
+        for chunk in chain.llm.stream(prompt_value):
+            merge_usage(usage, getattr(chunk, "usage_metadata", None))
+            _routing_metadata(usage, chunk.response_metadata)
+            text = chunk_text(chunk)
+            if text:
+                chunks.append(text)
+                yield text
+    _settle(ticket, usage)
+    with span("memory.save"):
+        chain.prep_outputs(inputs, {chain.output_key: "".join(chunks)})
+
+def run_chain(chain, inputs, usage=None, provider=None):
+    """Blocking counterpart of stream_chain that also reports usage metadata."""
+    inputs, prompt_value = _prepare(chain, inputs)
+    usage = {} if usage is None else usage
+    with _slot(provider, prompt_value) as ticket:
+        message = chain.llm.invoke(prompt_value)
+    merge_usage(usage, getattr(message, "usage_metadata", None))
+    _routing_metadata(usage, message.response_metadata)
+    _settle(ticket, usage)
+    output = chunk_text(message)
+    with span("memory.save"):
+        chain.prep_outputs(inputs, {chain.output_key: output})
+    return output
+
+def replay_chain(chain, inputs, output):
+    """Yield a reply that is already known (e.g. cached) and commit it to memory."""
+    with span("memory.load"):
+        inputs = chain.prep_inputs(inputs)
+    yield output
+    with span("memory.save"):
+        chain.prep_outputs(inputs, {chain.output_key: output})
+
+def commit_chain(chain, inputs, output):
+    """Commit a reply prepared beforehand (e.g. speculatively) to memory; only appends the exchange."""
+    with span("memory.save"):
+        chain.prep_outputs(inputs, {chain.output_key: output})
+
+def merge_streams(streams):
+    """Consume several text streams at once, each on its own worker thread.
+
+    streams maps a key (e.g. a model label) to an iterator of text. Yields
+    (key, text) in arrival order, (key, None) when a stream is finished and
+    (key, exception) when it fails, so the caller (the script thread) can
+    draw every stream as it arrives.
+    """
+    events = queue.Queue()
+
+    def worker(key, stream):
+        try:
+            for text in stream:
+                events.put((key, text))
+            events.put((key, None))
+        except Exception as e:
+            events.put((key, e))
+
+    for key, stream in streams.items():
+        thread = threading.Thread(target=contextvars.copy_context().run, args=(worker, key, stream), daemon=True)
+        add_script_run_ctx(thread)
+        thread.start()
+    remaining = len(streams)
+    while remaining:
+        key, item = events.get()
+        if item is None or isinstance(item, Exception):
+            remaining -= 1
+        yield key, item
@@ -0,0 +1,140 @@
+#Per-turn latency telemetry
+#Every reply is timed from the moment the question is submitted: queue wait
+#(until the model call starts), time to first token, generation speed, total
+#latency and output token count.
+
+#Python libraries
+import time
+from dataclasses import dataclass, field
+
+from tokens import count_tokens
+
+
+#How often the live status label is refreshed while a reply streams (seconds)
+LIVE_UPDATE_INTERVAL = 0.25
+
+
+@dataclass
+class TurnStats:
+    model: str
+    provider_model: str = "gpt-4o"
+    submitted: float = field(default_factory=time.perf_counter)
+    started: float = None
+    first_token: float = None
+    finished: float = None
+    output_tokens: int = 0
+    chunks: int = 0
+    cached_response: bool = False
+    speculative_response: bool = False
+    #Provider usage metadata, and which route answered after how long in the queue
+    #(answered_by, queue_wait), filled by streaming.stream_chain/run_chain
+    usage: dict = field(default_factory=dict)
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def token(self):
+        now = time.perf_counter()
+        if self.first_token is None:
+            self.first_token = now
+        self.chunks += 1
+
+    def finish(self, output):
+        self.finished = time.perf_counter()
+        if self.first_token is None:
+            #Blocking calls deliver the whole reply at once
+            self.first_token = self.finished
+        self.output_tokens = self.usage.get("output_tokens") or count_tokens(output, self.provider_model)
+
+    @property
+    def answered_by(self):
+        return self.usage.get("answered_by", self.model)
+
+    @property
+    def input_tokens(self):
+        return self.usage.get("input_tokens")
+
+    @property
+    def cached_input_tokens(self):
+        return self.usage.get("input_token_details", {}).get("cache_read")
+
+    @property
+    def queue_wait(self):
+        #Until the reply started, plus the wait for a scheduler slot reported by the call
+        if self.started is None:
+            return None
+        return self.started - self.submitted + (self.usage.get("queue_wait") or 0)
+
+    @property
+    def time_to_first_token(self):
+        return None if self.first_token is None else self.first_token - self.submitted
+
+    @property
+    def total_latency(self):
+        return None if self.finished is None else self.finished - self.submitted
+
+    @property
+    def tokens_per_second(self):
+        if self.finished is None:
+            return None
+        generation = self.finished - self.first_token
+        if generation <= 0:
+            return None
+        return self.output_tokens / generation
+
+    def label(self):
+        """Short status line, usable while the reply is still streaming."""
+        if self.first_token is None:
+            waited = time.perf_counter() - self.submitted
+            return f"Waiting for {self.model}... {waited:.1f} s"
+        if self.finished is None:
+            return f"First token after {self.time_to_first_token:.2f} s · {self.chunks} chunks received"
+        if self.cached_response:
+            return f"Answered from the response cache in {self.total_latency:.2f} s"
+        if self.speculative_response:
+            return f"{self.answered_by} answered in advance · shown in {self.total_latency:.2f} s"
+        rate = self.tokens_per_second
+        rate = f" · {rate:.1f} tokens/s" if rate else ""
+        cached = f" · {self.cached_input_tokens} cached input tokens" if self.cached_input_tokens else ""
+        return (f"{self.answered_by} answered in {self.total_latency:.2f} s · first token after "
+                f"{self.time_to_first_token:.2f} s · {self.output_tokens} tokens{rate}{cached}")
+
+    def as_dict(self):
+        def rounded(value):
+            return None if value is None else round(value, 3)
+        return {
+            "model": self.model,
+            "answered_by": self.answered_by,
+            "cached_response": self.cached_response,
+            "speculative_response": self.speculative_response,
+            "queue_wait_s": rounded(self.queue_wait),
+            "time_to_first_token_s": rounded(self.time_to_first_token),
+            "total_latency_s": rounded(self.total_latency),
+            "input_tokens": self.input_tokens,
+            "cached_input_tokens": self.cached_input_tokens,
+            "output_tokens": self.output_tokens,
+            "tokens_per_second": rounded(self.tokens_per_second),
+        }
+
+
+#functions
+def timed_stream(stream, stats, on_update=None):
+    """Pass a text stream through while recording its timings in stats.
+
+    on_update(stats) is called at most every LIVE_UPDATE_INTERVAL seconds and
+    once more when the stream ends.
+    """
+    stats.start()
+    last_update = 0.0
+    chunks = []
+    for text in stream:
+        stats.token()
+        chunks.append(text)
+        now = time.perf_counter()
+        if on_update is not None and now - last_update >= LIVE_UPDATE_INTERVAL:
+            on_update(stats)
+            last_update = now
+        yield text
+    stats.finish("".join(chunks))
+    if on_update is not None:
+        on_update(stats)
@@ -0,0 +1,27 @@
+from langchain.memory import ConversationBufferMemory
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from chat_memory import budgeted_memory
+from prompting import PersonaChatPrompt
+
+
+def prompts(provider, turns=10):
+    prompt = PersonaChatPrompt(instructions="You are following persona: {profile}.", profile="Olga, a teacher", provider=provider)
+    memory = ConversationBufferMemory(memory_key="chat_history", input_key="input", return_messages=True)
+    memory = budgeted_memory(memory, True, "gpt-4o", 80)
+    for i in range(turns):
+        memory.save_context({"input": f"Question {i} about your teaching?"}, {"response": f"Answer {i} about teaching math to children."})
+        history = memory.load_memory_variables({"input": "Next question?"})["chat_history"]
+        yield prompt.format_messages(chat_history=history, input="Next question?")
+
+
+def test_condensed_history_travels_with_the_question():
+    for provider in ("openai", "anthropic"):
+        messages = list(prompts(provider))
+        #The system prompt stays the same as the window moves, so its cached prefix is reused
+        assert len({str(turn[0].content) for turn in messages}) == 1
+        last = messages[-1]
+        assert sum(isinstance(message, SystemMessage) for message in last) == 1
+        assert isinstance(last[-1], HumanMessage)
+        assert "Earlier in the interview" in str(last[-1].content)
+        assert "Next question?" in str(last[-1].content)
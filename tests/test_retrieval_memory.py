@@ -0,0 +1,38 @@
+import pickle
+
+from langchain.memory import ConversationBufferMemory
+from langchain_core.messages import SystemMessage
+
+from chat_memory import budgeted_memory
+from retrieval import TurnIndex
+
+
+def interview(turns, max_token_limit):
+    memory = ConversationBufferMemory(memory_key="chat_history", input_key="input", return_messages=True)
+    memory = budgeted_memory(memory, True, "gpt-4o", max_token_limit, recall=True)
+    for i in range(turns):
+        answer = "My sister Olga breeds alpacas in Vancouver." if i == 1 else f"Answer {i} about teaching math."
+        memory.save_context({"input": f"Question {i}?"}, {"response": answer})
+    return memory
+
+
+def test_short_interview_is_sent_verbatim():
+    memory = interview(8, 6000)
+    history = memory.load_memory_variables({"input": "Tell me about your sister"})["chat_history"]
+    assert len(history) == 16
+    assert not any(isinstance(message, SystemMessage) for message in history)
+
+
+def test_long_interview_recalls_relevant_turns():
+    memory = interview(200, 300)
+    history = memory.load_memory_variables({"input": "Tell me about your sister and the alpacas"})["chat_history"]
+    assert isinstance(history[0], SystemMessage)
+    assert "Olga" in history[0].content
+
+
+def test_index_grows_with_vocabulary():
+    index = TurnIndex()
+    index.add("alpacas in Vancouver")
+    index.add("teaching math")
+    assert len(pickle.dumps(index)) < 4096
+    assert [row for row, _ in index.search("alpacas", 1)] == [0]
@@ -0,0 +1,144 @@
+import time
+
+import pytest
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from routing import CircuitBreaker, RoutedChatModel, get_circuit_breakers
+
+
+class ScriptedModel(BaseChatModel):
+    """Fails its first `failures` calls, then answers `reply` after `delay` seconds."""
+
+    reply: str = "hello"
+    failures: int = 0
+    delay: float = 0.0
+    calls: int = 0
+
+    @property
+    def _llm_type(self):
+        return "scripted"
+
+    def _answer(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.calls <= self.failures:
+            raise ConnectionError(f"{self.reply} is down")
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        self._answer()
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.reply))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        self._answer()
+        yield ChatGenerationChunk(message=AIMessageChunk(content=self.reply))
+
+
+@pytest.fixture
+def breakers():
+    get_circuit_breakers.clear()
+    breakers = get_circuit_breakers()
+    for breaker in breakers.values():
+        breaker.cooldown = 0.2
+    yield breakers
+    get_circuit_breakers.clear()
+
+
+def routed(*models, **params):
+    labels = [("GPT 4o", "openai"), ("DeepSeek Chat", "deepseek")]
+    routes = [(label, provider, model) for (label, provider), model in zip(labels, models)]
+    return RoutedChatModel(routes=routes, retry_backoff=0, **params)
+
+
+def ask(llm, stream=False):
+    messages = [HumanMessage(content="Who are you?")]
+    if stream:
+        chunks = list(llm.stream(messages))
+        return "".join(chunk.content for chunk in chunks), chunks[0].response_metadata["answered_by"]
+    message = llm.invoke(messages)
+    return message.content, message.response_metadata["answered_by"]
+
+
+def trip(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_breaker_half_open_trial():
+    breaker = CircuitBreaker(failures=1, cooldown=0.1)
+    trip(breaker)
+    assert not breaker.allow() and breaker.acquire() is None
+    time.sleep(0.15)
+    #Checking changes nothing; the trial is only taken by a request that is sent
+    assert breaker.allow() and breaker.allow()
+    assert breaker.state == "open"
+    assert breaker.acquire() is True
+    assert breaker.state == "half-open"
+    assert not breaker.allow() and breaker.acquire() is None
+    #A cancelled trial is given back
+    breaker.release(True)
+    assert breaker.acquire() is True
+    #A trial that never reports back is replaced after another cooldown
+    time.sleep(0.15)
+    assert breaker.acquire() is True
+    breaker.record_success(0.1)
+    assert breaker.state == "closed" and breaker.acquire() is False
+
+
+def test_fallback_breaker_stays_usable_while_primary_answers(breakers):
+    llm = routed(ScriptedModel(reply="primary"), ScriptedModel(reply="fallback"))
+    trip(breakers["DeepSeek Chat"])
+    time.sleep(0.25)
+    for _ in range(3):
+        assert ask(llm) == ("primary", "GPT 4o")
+    assert breakers["DeepSeek Chat"].state == "open"
+    assert [route[0] for route in llm._plan()[0]] == ["GPT 4o", "DeepSeek Chat"]
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_retry_then_answer(breakers, stream):
+    primary = ScriptedModel(reply="primary", failures=1)
+    llm = routed(primary, ScriptedModel(reply="fallback"), max_retries=1)
+    assert ask(llm, stream) == ("primary", "GPT 4o")
+    assert primary.calls == 2
+    assert breakers["GPT 4o"].state == "closed" and breakers["GPT 4o"].failures == 0
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_failover_to_next_provider(breakers, stream):
+    primary = ScriptedModel(reply="primary", failures=10)
+    llm = routed(primary, ScriptedModel(reply="fallback"), max_retries=1)
+    assert ask(llm, stream) == ("fallback", "DeepSeek Chat")
+    assert primary.calls == 2
+    assert breakers["GPT 4o"].failures == 2
+
+
+def test_open_breaker_is_skipped(breakers):
+    primary = ScriptedModel(reply="primary")
+    llm = routed(primary, ScriptedModel(reply="fallback"))
+    trip(breakers["GPT 4o"])
+    assert ask(llm) == ("fallback", "DeepSeek Chat")
+    assert primary.calls == 0
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_hedge_answers_from_the_faster_provider(breakers, stream):
+    llm = routed(ScriptedModel(reply="primary", delay=1.0), ScriptedModel(reply="fallback"), hedge_after=0.1)
+    started = time.monotonic()
+    assert ask(llm, stream) == ("fallback", "DeepSeek Chat")
+    assert time.monotonic() - started < 0.9
+
+
+def test_hedge_loser_gives_back_its_trial(breakers):
+    primary = ScriptedModel(reply="primary", delay=0.5)
+    llm = routed(primary, ScriptedModel(reply="fallback"), hedge_after=0.1)
+    breaker = breakers["GPT 4o"]
+    trip(breaker)
+    time.sleep(0.25)
+    assert ask(llm, stream=True) == ("fallback", "DeepSeek Chat")
+    assert breaker.state == "half-open" and breaker.trial_started is not None
+    #The slow primary notices it was cancelled once its reply arrives
+    time.sleep(0.6)
+    assert breaker.trial_started is None and breaker.allow()
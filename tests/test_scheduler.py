@@ -0,0 +1,100 @@
+import threading
+import time
+
+import pytest
+
+from scheduler import Scheduler, SchedulerCancelled
+
+
+class Interrupted(Exception):
+    pass
+
+
+def hold_slot(scheduler, entered, release):
+    with scheduler.slot("openai", 1, session="holder"):
+        entered.set()
+        release.wait(5)
+
+
+def start_holder(scheduler):
+    entered, release = threading.Event(), threading.Event()
+    thread = threading.Thread(target=hold_slot, args=(scheduler, entered, release), daemon=True)
+    thread.start()
+    assert entered.wait(5)
+    return thread, release
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_interrupted_wait_leaves_the_queue():
+    scheduler = Scheduler(max_concurrent=1)
+    holder, release = start_holder(scheduler)
+
+    def on_wait(position):
+        raise Interrupted()
+
+    with pytest.raises(Interrupted):
+        with scheduler.slot("openai", 1, session="student", on_wait=on_wait):
+            pass
+    release.set()
+    holder.join(5)
+    assert scheduler.stats() == {"running": 0, "waiting": 0, "sessions_waiting": 0}
+
+
+def test_interrupted_wait_gives_back_a_granted_slot():
+    scheduler = Scheduler(max_concurrent=1)
+    holder, release = start_holder(scheduler)
+
+    def on_wait(position):
+        #The holder finishes and the slot is granted to this call before it gives up
+        release.set()
+        holder.join(5)
+        raise Interrupted()
+
+    with pytest.raises(Interrupted):
+        with scheduler.slot("openai", 1, session="student", on_wait=on_wait):
+            pass
+    assert scheduler.stats() == {"running": 0, "waiting": 0, "sessions_waiting": 0}
+    with scheduler.slot("openai", 1, session="next"):
+        assert scheduler.stats()["running"] == 1
+
+
+def test_cancelled_wait_leaves_the_queue():
+    scheduler = Scheduler(max_concurrent=1)
+    holder, release = start_holder(scheduler)
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(SchedulerCancelled):
+        with scheduler.slot("openai", 1, session="student", cancel=cancel):
+            pass
+    release.set()
+    holder.join(5)
+    assert scheduler.stats()["waiting"] == 0
+
+
+def test_background_calls_wait_for_foreground_calls():
+    scheduler = Scheduler(max_concurrent=1)
+    holder, release = start_holder(scheduler)
+    order, queued = [], []
+
+    def call(name, background):
+        with scheduler.slot("openai", 1, session=name, on_wait=queued.append, background=background):
+            order.append(name)
+
+    threads = [threading.Thread(target=call, args=("speculation", True), daemon=True)]
+    threads[0].start()
+    assert wait_until(lambda: len(queued) == 1)
+    threads.append(threading.Thread(target=call, args=("student", False), daemon=True))
+    threads[1].start()
+    assert wait_until(lambda: len(queued) == 2)
+    release.set()
+    for thread in [holder, *threads]:
+        thread.join(5)
+    assert order == ["student", "speculation"]
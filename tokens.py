@@ -0,0 +1,37 @@
+#Token counting helpers
+#tiktoken is used for every provider; for non-OpenAI models this is a close
+#estimate rather than the provider's exact count.
+
+#external libraries
+import tiktoken
+
+#Python libraries
+from functools import lru_cache
+
+
+DEFAULT_ENCODING = "cl100k_base"
+
+
+#functions
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    """Return the tiktoken encoding for a model, or None if none can be loaded."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        pass
+    except Exception:
+        return None
+    try:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception:
+        #Encodings are downloaded on first use; fall back to a rough estimate offline
+        return None
+
+def count_tokens(text, model="gpt-4o"):
+    if not text:
+        return 0
+    encoding = get_encoding(model)
+    if encoding is None:
+        return max(1, len(text) // 4)
+    return len(encoding.encode(text, disallowed_special=()))
@@ -0,0 +1,331 @@
+#Opt-in span tracing of Streamlit reruns
+#With PEARL_TRACE=1 (or ?trace=1 in the URL of one session) every rerun of the
+#script and every fragment rerun becomes a trace: the script marks its phases
+#(CSS, sidebar, chain construction, history rendering, ...), and model calls,
+#failover attempts and memory loads/updates are nested spans. Finished traces
+#are appended to PEARL_TRACE_FILE as OTLP/JSON lines (one export request per
+#trace, the shape the OpenTelemetry collector's file receiver reads) and the
+#latest ones are kept in the session for a waterfall in a debug expander.
+
+#external libraries
+import altair as alt
+import streamlit as st
+
+#langchain libraries
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.tracers.context import register_configure_hook
+
+#Python libraries
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+TRACING = os.getenv("PEARL_TRACE", "0") == "1"
+TRACE_FILE = os.getenv("PEARL_TRACE_FILE", os.path.join(os.getenv("PEARL_DATA_DIR", ".pearl"), "traces.jsonl"))
+#Finished traces kept per session for the waterfall
+TRACES_KEPT = 10
+
+SERVICE_NAME = "pearl"
+#OTLP enums
+SPAN_KIND_INTERNAL = 1
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+#Innermost open span of the current thread, and the trace's langchain callback handler
+current_span = contextvars.ContextVar("current_span", default=None)
+trace_handler = contextvars.ContextVar("trace_handler", default=None)
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class Span:
+    def __init__(self, trace, name, parent=None, phase=False, **attributes):
+        self.trace = trace
+        self.name = name
+        self.parent = parent
+        self.phase = phase
+        self.span_id = os.urandom(8).hex()
+        self.attributes = attributes
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+        self.open_phase = None
+
+    def child(self, name, phase=False, **attributes):
+        span = Span(self.trace, name, self, phase, **attributes)
+        self.trace.add(span)
+        return span
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self, error=None):
+        if self.end is not None:
+            return
+        if self.open_phase is not None:
+            self.open_phase.finish()
+        self.error = error
+        self.end = time.time_ns()
+        self.trace.ended(self)
+
+    @property
+    def depth(self):
+        return 0 if self.parent is None else self.parent.depth + 1
+
+    def as_otlp(self):
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": SPAN_KIND_INTERNAL,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [_attribute(key, value) for key, value in self.attributes.items() if value is not None],
+            "status": {"code": STATUS_ERROR, "message": self.error} if self.error else {"code": STATUS_OK},
+        }
+        if self.parent is not None:
+            span["parentSpanId"] = self.parent.span_id
+        return span
+
+
+class Trace:
+    """The spans of one rerun."""
+
+    def __init__(self, name, writer, **attributes):
+        self.trace_id = os.urandom(16).hex()
+        self.writer = writer
+        self.spans = []
+        self.finished = False
+        self._lock = threading.Lock()
+        self.handler = SpanHandler()
+        self.root = Span(self, name, **attributes)
+        self.spans.append(self.root)
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def ended(self, span):
+        if span is self.root:
+            with self._lock:
+                self.finished = True
+                spans = [span for span in self.spans if span.end is not None]
+            self.writer.write(spans)
+        elif self.finished:
+            #Work that outlived its rerun (e.g. a background summary update)
+            self.writer.write([span])
+
+    def waterfall(self):
+        """Return one row per finished span: offset and duration from the start of the rerun (ms)."""
+        with self._lock:
+            spans = [span for span in self.spans if span.end is not None]
+        return [
+            {
+                "span": f"{'  ' * span.depth}{span.name}",
+                "start_ms": round((span.start - self.root.start) / 1e6, 1),
+                "end_ms": round((span.end - self.root.start) / 1e6, 1),
+                "duration_ms": round((span.end - span.start) / 1e6, 1),
+                "error": span.error or "",
+            }
+            for span in spans
+        ]
+
+
+class SpanHandler(BaseCallbackHandler):
+    """Turns langchain model calls into spans of the trace active when they start."""
+
+    def __init__(self):
+        self._runs = {}
+        self._lock = threading.Lock()
+
+    def _start(self, run_id, parent_run_id, metadata, kwargs):
+        with self._lock:
+            parent = self._runs.get(parent_run_id)
+        parent = parent or _active_span()
+        if parent is None:
+            return
+        metadata = metadata or {}
+        params = kwargs.get("invocation_params") or {}
+        if params.get("_type") == "pearl-routed":
+            #The failover wrapper: its attempts are nested spans of their own
+            span = parent.child("llm failover")
+        else:
+            model = metadata.get("ls_model_name") or params.get("model_name") or params.get("model")
+            span = parent.child(f"llm {model}", **{"gen_ai.system": metadata.get("ls_provider"), "gen_ai.request.model": model})
+        with self._lock:
+            self._runs[run_id] = span
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        self._start(run_id, parent_run_id, metadata, kwargs)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        self._start(run_id, parent_run_id, metadata, kwargs)
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        span = self._runs.get(run_id)
+        if span is not None and "time_to_first_token_ms" not in span.attributes:
+            span.set(time_to_first_token_ms=round((time.time_ns() - span.start) / 1e6, 1))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        with self._lock:
+            span = self._runs.pop(run_id, None)
+        if span is None:
+            return
+        usage = {}
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or usage
+        span.set(**{"gen_ai.usage.input_tokens": usage.get("input_tokens"), "gen_ai.usage.output_tokens": usage.get("output_tokens")})
+        span.finish()
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self._lock:
+            span = self._runs.pop(run_id, None)
+        if span is not None:
+            span.finish(error=f"{type(error).__name__}: {error}")
+
+
+class TraceWriter:
+    """Appends finished traces to the JSONL trace file."""
+
+    def __init__(self, path=TRACE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def write(self, spans):
+        line = json.dumps({
+            "resourceSpans": [{
+                "resource": {"attributes": [_attribute("service.name", SERVICE_NAME), _attribute("process.pid", os.getpid())]},
+                "scopeSpans": [{"scope": {"name": "pearl.tracing"}, "spans": [span.as_otlp() for span in spans]}],
+            }]
+        })
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+@st.cache_resource(show_spinner=False)
+def get_trace_writer():
+    """Return the trace file writer shared by all sessions of this process."""
+    return TraceWriter()
+
+
+#Model calls made while a trace is active report to its handler
+register_configure_hook(trace_handler, inheritable=True)
+
+
+#functions
+def _active_span():
+    span = current_span.get()
+    #Script threads are reused across reruns; a finished trace is not active
+    return None if span is None or span.trace.finished else span
+
+def tracing_enabled():
+    return TRACING or st.query_params.get("trace") == "1"
+
+def _begin(name, **attributes):
+    trace = Trace(name, get_trace_writer(), **attributes)
+    current_span.set(trace.root)
+    trace_handler.set(trace.handler)
+    return trace
+
+def _end(trace, error=None):
+    trace.root.finish(error=error)
+    current_span.set(None)
+    trace_handler.set(None)
+    traces = st.session_state.setdefault("traces", deque(maxlen=TRACES_KEPT))
+    traces.append(trace)
+
+def start_trace(name, **attributes):
+    """Start the trace of a script rerun (no-op unless tracing is enabled); end it with finish_trace."""
+    previous = _active_span()
+    if previous is not None:
+        #The previous rerun stopped early (st.rerun, st.stop or an exception)
+        _end(previous.trace, error="interrupted")
+    current_span.set(None)
+    trace_handler.set(None)
+    if tracing_enabled():
+        return _begin(name, **attributes)
+
+def finish_trace():
+    span = _active_span()
+    if span is not None:
+        _end(span.trace)
+
+def phase(name, **attributes):
+    """End the current phase of the running span and start the next one."""
+    span = _active_span()
+    if span is None:
+        return
+    owner = span.parent if span.phase else span
+    if owner.open_phase is not None:
+        owner.open_phase.finish()
+    owner.open_phase = owner.child(name, phase=True, **attributes)
+    current_span.set(owner.open_phase)
+
+@contextmanager
+def span(name, **attributes):
+    """Record the block as a span of the running trace (yields None when nothing is traced)."""
+    parent = _active_span()
+    if parent is None:
+        yield None
+        return
+    child = parent.child(name, **attributes)
+    token = current_span.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.finish(error=f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        current_span.reset(token)
+        child.finish()
+
+def traced(name):
+    """Decorator for fragments: a span of the script's trace, or a trace of its own on a fragment rerun."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _active_span() is not None:
+                with span(name):
+                    return function(*args, **kwargs)
+            if not tracing_enabled():
+                return function(*args, **kwargs)
+            trace = _begin(name, fragment=True)
+            error = None
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                raise
+            finally:
+                _end(trace, error=error)
+        return wrapper
+    return decorate
+
+def show_waterfall(trace):
+    """Draw the spans of a trace as a waterfall chart."""
+    rows = trace.waterfall()
+    chart = alt.Chart(alt.Data(values=rows)).mark_bar().encode(
+        x=alt.X("start_ms:Q", title="ms since the rerun started"),
+        x2="end_ms:Q",
+        y=alt.Y("span:N", sort=None, title=None),
+        color=alt.condition(alt.datum.error != "", alt.value("#DC2626"), alt.value("#4F46E5")),
+        tooltip=["span:N", "duration_ms:Q", "start_ms:Q", "error:N"],
+    ).properties(height=max(120, 22 * len(rows)))
+    st.altair_chart(chart, use_container_width=True)
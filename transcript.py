@@ -0,0 +1,81 @@
+#Interview transcripts
+#Transcript keeps every export format up to date one turn at a time, so
+#preparing a download on a rerun only joins strings that were formatted when
+#each turn happened; the history is never re-serialized or re-parsed.
+
+#Python libraries
+import csv
+import io
+import json
+
+
+#Download formats: file extension -> (label, MIME type)
+FORMATS = {
+    "txt": ("Text", "text/plain"),
+    "md": ("Markdown", "text/markdown"),
+    "jsonl": ("JSON Lines", "application/jsonl"),
+    "csv": ("CSV", "text/csv"),
+}
+CSV_COLUMNS = ["turn", "question", "answer", "model"]
+
+
+#functions
+def _txt_line(question, answer):
+    return f"{question}\n{answer}\n"
+
+def _csv_line(row):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(row)
+    return buffer.getvalue()
+
+def format_exchanges(exchanges):
+    """Return the plain-text transcript of (question, answer) pairs, as downloaded from the apps."""
+    return "".join(_txt_line(question, answer) for question, answer in exchanges)
+
+
+class Transcript:
+    """Interview transcript that is extended one turn at a time.
+
+    persona, when given, heads the text and Markdown exports (app.py keeps the
+    persona as the first line of its download).
+    """
+
+    def __init__(self, persona=None):
+        self.persona = persona
+        self._turns = 0
+        self._parts = {"txt": [], "md": [], "jsonl": [], "csv": [_csv_line(CSV_COLUMNS)]}
+        self._exports = {}
+
+    def __len__(self):
+        return self._turns
+
+    @property
+    def persona(self):
+        return self._persona
+
+    @persona.setter
+    def persona(self, persona):
+        self._persona = persona
+        self._exports = {}
+
+    def add(self, question, answer, model=None):
+        """Append one question and its answer to every export format."""
+        self._turns += 1
+        record = {"turn": self._turns, "question": question, "answer": answer, "model": model}
+        self._parts["txt"].append(_txt_line(question, answer))
+        speaker = f"Persona ({model})" if model else "Persona"
+        self._parts["md"].append(f"**Researcher:** {question}\n\n**{speaker}:** {answer}\n\n")
+        self._parts["jsonl"].append(json.dumps(record, ensure_ascii=False) + "\n")
+        self._parts["csv"].append(_csv_line([record[column] or "" for column in CSV_COLUMNS]))
+        self._exports = {}
+
+    def export(self, fmt="txt"):
+        """Return the transcript in one of FORMATS; joined at most once per turn."""
+        if fmt not in self._exports:
+            head = ""
+            if self.persona and fmt == "txt":
+                head = f"{self.persona}\n"
+            elif fmt == "md":
+                head = "# PEARL interview\n\n" + (f"**Persona:** {self.persona}\n\n" if self.persona else "")
+            self._exports[fmt] = head + "".join(self._parts[fmt])
+        return self._exports[fmt]